@@ -5,6 +5,16 @@ import pandas as pd
 import altair as alt
 alt.data_transformers.disable_max_rows()
 
+try:
+    from ms_downsample import MAX_POINTS, downsample_frame
+except ModuleNotFoundError:
+    # ms_downsample lives in the repo root; imported without the root on
+    # sys.path, chromatograms are plotted with every point
+    MAX_POINTS = None
+
+    def downsample_frame(df, x, y, by=None, max_points=None):
+        return df
+
 
 
 class IMQCsv:
@@ -109,7 +119,10 @@ class IMQCsv:
             })
             return df
 
-    def _make_chart(self, df, name):
+    def _make_chart(self, df, name, max_points=MAX_POINTS):
+            # chromatograms are min/max downsampled to the point budget
+            df = downsample_frame(df, "Times", "Intensity", by="Sample",
+                                  max_points=max_points)
             line = alt.Chart(df).mark_line().encode(
                 x=alt.X("Times:Q", title="Time (min)"),
                 y=alt.Y("Intensity:Q", title="Intensity (counts)"),
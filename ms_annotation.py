@@ -0,0 +1,154 @@
+###############################################################
+# annotation of MS2 spectra with theoretical fragment ions    #
+###############################################################
+
+import numpy as np
+import pandas as pd
+
+from ms_fragments import PREFIX_IONS, mass_cache
+
+MATCH_COLUMNS = (
+    "label", "ion_type", "ordinal", "charge", "theoretical_mz",
+    "observed_mz", "intensity", "ppm_error", "peak",
+)
+
+
+def _labels(ion_type, ordinal, charge):
+    """Labels such as b3, y5++ or the ion type alone for ordinal 0."""
+    return [
+        f"{t}{o}{'+' * c if c > 1 else ''}" if o > 0 else t
+        for t, o, c in zip(ion_type, ordinal, charge)
+    ]
+
+
+def ion_table(peptide, types=("b", "y"), max_charge=1, aa_mass=None, extra=None):
+    """
+    Theoretical ions of one peptide, served from ms_fragments.mass_cache.
+
+    :arg peptide:       (str)   peptide sequence
+    :arg types:         (tuple) ion types, see ms_fragments.fragment_ladders
+    :arg max_charge:    (int)   maximum fragment charge
+    :arg aa_mass:       (dict) <optional>   residue masses of modified residues
+    :arg extra:         (dict) <optional>   other ions {name: m/z or list of
+                                            m/z}, e.g. oxonium ions from
+                                            ms_handler.modifications
+
+    returns dict of np.arrays: label, ion_type, ordinal, charge and mz
+    """
+    ladder = mass_cache.ladder(peptide, types=types, max_charge=max_charge, aa_mass=aa_mass)
+    ions = {
+        "ion_type": ladder["ion_type"].astype(object),
+        "ordinal": ladder["ordinal"],
+        "charge": ladder["charge"],
+        "mz": ladder["mz"],
+    }
+    if extra:
+        ions = _concat_ions(ions, _extra_ions(extra))
+    ions["label"] = np.array(_labels(ions["ion_type"], ions["ordinal"], ions["charge"]), dtype=object)
+    return ions
+
+
+def _extra_ions(extra):
+    """Ion arrays of {name: m/z or list of m/z}; ordinal and charge are 0."""
+    names, masses = [], []
+    for name, values in extra.items():
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        names.extend([name] * values.shape[0])
+        masses.append(values)
+    masses = np.concatenate(masses) if masses else np.zeros(0)
+    return {
+        "ion_type": np.array(names, dtype=object),
+        "ordinal": np.zeros(masses.shape[0], dtype=np.int16),
+        "charge": np.zeros(masses.shape[0], dtype=np.int8),
+        "mz": masses,
+    }
+
+
+def _concat_ions(*tables):
+    return {name: np.concatenate([t[name] for t in tables]) for name in tables[0]}
+
+
+def ions_from_dict(frag_dict, peptide):
+    """
+    Ion table from the {ion type: [m/z, ...]} dicts made by fragments().
+
+    Ladders of the ion types in ms_fragments are laid out site by site with
+    all charges of a site in a row, so ordinal and charge follow from the
+    position in the list. Lists that do not fit the peptide length, and keys
+    that are not ion types (e.g. oxonium ions), are labeled with their key.
+
+    returns dict of np.arrays, see ion_table
+    """
+    sites = max(len(peptide) - 1, 0)
+    tables = []
+    for key, values in frag_dict.items():
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        n = values.shape[0]
+        if len(key) == 1 and key in "abcxyz" and sites and n % sites == 0 and n:
+            max_charge = n // sites
+            site = np.arange(n) // max_charge
+            ordinal = site + 1 if key in PREFIX_IONS else sites - site
+            tables.append({
+                "ion_type": np.full(n, key, dtype=object),
+                "ordinal": ordinal.astype(np.int16),
+                "charge": (np.arange(n) % max_charge + 1).astype(np.int8),
+                "mz": values,
+            })
+        else:
+            tables.append(_extra_ions({key: values}))
+    ions = _concat_ions(*tables) if tables else _extra_ions({})
+    ions["label"] = np.array(_labels(ions["ion_type"], ions["ordinal"], ions["charge"]), dtype=object)
+    return ions
+
+
+def annotate_spectrum(mz, intensity, ions, tolerance=25):
+    """
+    Match theoretical ions against the observed peaks of one spectrum.
+
+    Every theoretical ion is matched to its nearest observed peak with one
+    np.searchsorted over the sorted peaks, and kept when that peak lies
+    within `tolerance` ppm. Several ions can match the same peak.
+
+    :arg mz:        (np.array)  observed m/z
+    :arg intensity: (np.array)  observed intensities
+    :arg ions:      (dict)  theoretical ions with label, ion_type, ordinal,
+                            charge and mz, see ion_table or ions_from_dict
+    :arg tolerance: (float) ppm tolerance
+
+    returns pd.DataFrame of MATCH_COLUMNS, one row per matched ion in the
+    order of `ions`; ppm_error is (theoretical - observed) / theoretical as
+    in ms_handler.mass_error, peak is the index of the observed peak
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    theoretical = np.asarray(ions["mz"], dtype=np.float64)
+    if mz.shape[0] == 0 or theoretical.shape[0] == 0:
+        return pd.DataFrame({name: [] for name in MATCH_COLUMNS})
+
+    order = None
+    if np.any(mz[1:] < mz[:-1]):
+        order = np.argsort(mz, kind="stable")
+        mz, intensity = mz[order], intensity[order]
+
+    right = np.searchsorted(mz, theoretical, side="left")
+    left = np.clip(right - 1, 0, mz.shape[0] - 1)
+    right = np.clip(right, 0, mz.shape[0] - 1)
+    # ties go to the lower peak, as a nearest-value argmin would
+    nearest = np.where(
+        np.abs(mz[right] - theoretical) < np.abs(mz[left] - theoretical), right, left
+    )
+    ppm = (theoretical - mz[nearest]) / theoretical * 1e6
+    hit = np.flatnonzero(np.abs(ppm) <= tolerance)
+    peak = nearest[hit] if order is None else order[nearest[hit]]
+
+    return pd.DataFrame({
+        "label": np.asarray(ions["label"])[hit],
+        "ion_type": np.asarray(ions["ion_type"])[hit],
+        "ordinal": np.asarray(ions["ordinal"])[hit],
+        "charge": np.asarray(ions["charge"])[hit],
+        "theoretical_mz": theoretical[hit],
+        "observed_mz": mz[nearest[hit]],
+        "intensity": intensity[nearest[hit]],
+        "ppm_error": ppm[hit],
+        "peak": peak,
+    })
@@ -0,0 +1,94 @@
+###############################################################
+# min/max downsampling of chromatograms and spectra for plots #
+###############################################################
+
+import numpy as np
+import pandas as pd
+
+# default point budget of one series: 4 points per column of a 1000 px chart
+MAX_POINTS = 4000
+
+
+def minmax_indices(xs, ys, n_buckets):
+    """
+    Indices of the points kept by min/max (M4) bucketing.
+
+    The x range is split into `n_buckets` equal-width buckets and the first,
+    last, lowest and highest point of every bucket are kept. With at least
+    one bucket per pixel column, a line or bar chart of the kept points
+    rasterizes like the chart of all points, and every peak apex is kept.
+
+    :arg xs:        (array-like)    x values, e.g. retention time or m/z
+    :arg ys:        (array-like)    y values, e.g. intensity
+    :arg n_buckets: (int)   number of buckets
+
+    returns sorted indices into xs (np.array); all indices when the series
+    has no more than 4 * n_buckets points
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    n = xs.shape[0]
+    if n <= 4 * n_buckets:
+        return np.arange(n)
+
+    low, high = np.nanmin(xs), np.nanmax(xs)
+    if high > low:
+        bucket = ((xs - low) / (high - low) * n_buckets).astype(np.int64)
+        bucket = np.clip(bucket, 0, n_buckets - 1)
+    else:
+        bucket = np.zeros(n, dtype=np.int64)
+
+    # within each bucket: points by intensity and by x
+    by_y = np.lexsort((ys, bucket))
+    by_x = np.lexsort((xs, bucket))
+    sorted_bucket = bucket[by_y]
+    starts = np.flatnonzero(np.r_[True, sorted_bucket[1:] != sorted_bucket[:-1]])
+    stops = np.r_[starts[1:], n] - 1
+    return np.unique(np.concatenate([by_y[starts], by_y[stops], by_x[starts], by_x[stops]]))
+
+
+def downsample(xs, ys, max_points=MAX_POINTS):
+    """
+    Min/max downsampling of one series to about `max_points` points,
+    see minmax_indices. Series within the budget are returned unchanged.
+
+    :arg xs:            (array-like)    x values
+    :arg ys:            (array-like)    y values
+    :arg max_points:    (int) <optional>    point budget, None keeps all points
+
+    returns xs and ys (np.array)
+    """
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    if max_points is None or xs.shape[0] <= max_points:
+        return xs, ys
+    keep = minmax_indices(xs, ys, max(max_points // 4, 1))
+    return xs[keep], ys[keep]
+
+
+def downsample_frame(df, x, y, by=None, max_points=MAX_POINTS):
+    """
+    Min/max downsampling of the rows of a long-form plotting frame, one
+    series per value of `by`, see minmax_indices.
+
+    :arg df:            (pd.DataFrame)  plotting data
+    :arg x:             (str)   column of x values
+    :arg y:             (str)   column of y values
+    :arg by:            (str, list) <optional>  columns that separate series,
+                                                e.g. the color encoding
+    :arg max_points:    (int) <optional>    point budget of every series,
+                                            None keeps all rows
+
+    returns pd.DataFrame with the kept rows in their original order
+    """
+    if max_points is None or df.shape[0] <= max_points:
+        return df
+    xs = pd.to_numeric(df[x], errors="coerce").to_numpy(dtype=np.float64)
+    ys = pd.to_numeric(df[y], errors="coerce").to_numpy(dtype=np.float64)
+    n_buckets = max(max_points // 4, 1)
+    if by is None:
+        return df.iloc[minmax_indices(xs, ys, n_buckets)]
+
+    keep = []
+    for rows in df.groupby(by, sort=False).indices.values():
+        keep.append(rows[minmax_indices(xs[rows], ys[rows], n_buckets)])
+    return df.iloc[np.sort(np.concatenate(keep))]
@@ -0,0 +1,320 @@
+##############################################################
+# theoretical fragment and precursor masses of many peptides #
+##############################################################
+
+from collections import OrderedDict
+import numpy as np
+from pyteomics import mass
+
+# prefix ions hold the N-terminus of the peptide, the others the C-terminus
+PREFIX_IONS = "abc"
+
+
+def _residue_table(aa_mass=None):
+    """Lookup table of residue masses indexed by the ASCII code of the residue."""
+    aa_mass = mass.std_aa_mass if aa_mass is None else aa_mass
+    table = np.full(128, np.nan)
+    for residue, residue_mass in aa_mass.items():
+        if len(residue) == 1 and ord(residue) < 128:
+            table[ord(residue)] = residue_mass
+    return table
+
+
+def _ion_offset(ion_type, mass_data=None, ion_comp=None):
+    """Mass added to the residue sum of a fragment of `ion_type`, as in fast_mass."""
+    mass_data = mass.nist_mass if mass_data is None else mass_data
+    ion_comp = mass.std_ion_comp if ion_comp is None else ion_comp
+    if ion_type not in ion_comp:
+        raise ValueError(f"Unknown ion type {ion_type}")
+    water = mass_data["H"][0][0] * 2 + mass_data["O"][0][0]
+    return water + sum(mass_data[el][0][0] * num for el, num in ion_comp[ion_type].items())
+
+
+def residue_masses(peptides, aa_mass=None):
+    """
+    Residue masses of many peptides in one flat array.
+
+    :arg peptides:  (list)  peptide sequences in one-letter code
+    :arg aa_mass:   (dict) <optional>   residue masses, pyteomics std_aa_mass
+                                        by default; single characters only,
+                                        e.g. lower case for modified residues
+
+    returns flat residue masses (np.array) and peptide offsets
+    (np.array, len(peptides) + 1)
+    """
+    lengths = np.fromiter((len(p) for p in peptides), dtype=np.int64, count=len(peptides))
+    offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    codes = np.frombuffer("".join(peptides).encode("ascii"), dtype=np.uint8)
+    residues = _residue_table(aa_mass)[codes]
+    if np.isnan(residues).any():
+        unknown = sorted({chr(c) for c in codes[np.isnan(residues)]})
+        raise KeyError(f"No mass data for residues {', '.join(unknown)}")
+    return residues, offsets
+
+
+def precursor_masses(peptides, charges=None, aa_mass=None):
+    """
+    Monoisotopic masses, or m/z when charges are given, of many peptides.
+    Matches pyteomics.mass.fast_mass(peptide, charge=charge).
+
+    :arg peptides:  (list)  peptide sequences
+    :arg charges:   (int, array-like) <optional>    charge of every peptide
+
+    returns np.array
+    """
+    residues, offsets = residue_masses(peptides, aa_mass)
+    cumulative = np.concatenate(([0.0], np.cumsum(residues)))
+    neutral = cumulative[offsets[1:]] - cumulative[offsets[:-1]] + _ion_offset("M")
+    if charges is None:
+        return neutral
+    charges = np.broadcast_to(np.asarray(charges, dtype=np.float64), neutral.shape)
+    return np.abs((neutral + mass.nist_mass["H+"][0][0] * charges) / charges)
+
+
+def fragment_ladders(peptides, types=("b", "y"), max_charge=1, aa_mass=None):
+    """
+    Theoretical fragment ladders of many peptides from cumulative residue
+    masses, without a mass calculation per fragment.
+
+    Every peptide of n residues has n - 1 cleavage sites. The prefix ion at
+    site i holds residues [:i] and the suffix ion residues [i:], matching
+    pyteomics.mass.fast_mass(peptide[:i] or peptide[i:], ion_type, charge).
+    Fragments of one peptide are laid out by ion type, then site, then
+    charge.
+
+    :arg peptides:      (list, str) peptide sequences
+    :arg types:         (tuple) ion types, any key of pyteomics std_ion_comp
+                                (e.g. "a", "b", "c", "x", "y", "z")
+    :arg max_charge:    (int)   fragments are calculated for charges
+                                1..max_charge
+    :arg aa_mass:       (dict) <optional>   residue masses, see residue_masses
+
+    returns dict of np.arrays: mz, ion_type, ordinal (residues in the
+    fragment), charge and peptide (index into `peptides`) with one entry per
+    fragment, and offsets (len(peptides) + 1) so that peptide j owns
+    offsets[j]:offsets[j + 1]
+    """
+    if isinstance(peptides, str):
+        peptides = [peptides]
+    residues, pep_offsets = residue_masses(peptides, aa_mass)
+    lengths = np.diff(pep_offsets)
+    n_types, n_charges = len(types), max_charge
+
+    # cleavage sites: residue sums of the prefix [:i] for i in 1..n-1
+    cumulative = np.cumsum(residues)
+    # residue sum of every peptide alone, not of the peptides before it
+    totals = np.diff(np.concatenate([[0.0], cumulative])[pep_offsets])
+    sites = np.maximum(lengths - 1, 0)
+    site_pep = np.repeat(np.arange(lengths.shape[0]), sites)
+    site_start = np.cumsum(sites) - sites
+    ordinal = np.arange(sites.sum()) - site_start[site_pep] + 1
+    before = np.where(pep_offsets[site_pep] > 0, cumulative[pep_offsets[site_pep] - 1], 0.0)
+    prefix = cumulative[pep_offsets[site_pep] + ordinal - 1] - before
+    suffix = totals[site_pep] - prefix
+
+    # grid of type x site x charge, then grouped by peptide
+    charges = np.arange(1, n_charges + 1)
+    proton = mass.nist_mass["H+"][0][0]
+    grid_mz, grid_type, grid_ordinal = [], [], []
+    for ion_type in types:
+        if ion_type[0] in PREFIX_IONS:
+            neutral, ion_ordinal = prefix, ordinal
+        else:
+            neutral, ion_ordinal = suffix, lengths[site_pep] - ordinal
+        neutral = neutral + _ion_offset(ion_type)
+        grid_mz.append((neutral[:, None] + proton * charges[None, :]) / charges[None, :])
+        grid_type.append(np.full(neutral.shape[0] * n_charges, ion_type))
+        grid_ordinal.append(np.repeat(ion_ordinal, n_charges))
+
+    n_sites = site_pep.shape[0]
+    grid_pep = np.tile(np.repeat(site_pep, n_charges), n_types)
+    order = np.argsort(grid_pep, kind="stable")
+    counts = sites * n_types * n_charges
+    offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    mz = np.concatenate([g.ravel() for g in grid_mz]) if types else np.zeros(0)
+    ion_type = np.concatenate(grid_type) if types else np.zeros(0, dtype="<U1")
+    ordinals = np.concatenate(grid_ordinal) if types else np.zeros(0, dtype=np.int64)
+    return {
+        "mz": mz[order],
+        "ion_type": ion_type[order],
+        "ordinal": ordinals[order].astype(np.int16),
+        "charge": np.tile(charges, n_sites * n_types)[order].astype(np.int8),
+        "peptide": grid_pep[order],
+        "offsets": offsets,
+    }
+
+
+def fragments(peptide, types=("b", "y"), max_charge=1):
+    """
+    Function that returns theoretical fragments of peptide.
+    Modeled from : https://pyteomics.readthedocs.io/en/latest/examples/example_msms.html
+
+    Computed with fragment_ladders and memoized in mass_cache; use
+    fragment_ladders directly for many peptides.
+
+    :param peptide: (str) peptide sequence
+    :param types: (tuple) types of fragments desired
+    :param max_charge: (int) maximum charge state of fragment ions
+    """
+    ladder = mass_cache.ladder(peptide, types=types, max_charge=max_charge)
+    return {
+        ion_type: ladder["mz"][ladder["ion_type"] == ion_type].tolist()
+        for ion_type in types
+    }
+
+
+class MassCache:
+    """
+    Bounded LRU cache of fragment ladders and precursor masses.
+
+    Entries are keyed on (sequence, residue masses, ion types, max charge)
+    for ladders and (sequence, residue masses, charge) for precursors, so
+    modified residues given through aa_mass never collide with the
+    unmodified ones. When more than `max_entries` are held, the least
+    recently used entry is dropped. Cached arrays are read-only.
+    """
+
+    def __init__(self, max_entries=100000):
+        """
+        :arg max_entries:   (int)   number of entries held before the least
+                                    recently used ones are evicted
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f"MassCache of {len(self._entries)}/{self.max_entries} entries"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _mods_key(self, aa_mass):
+        """Hashable key of a residue mass table, None for the default one."""
+        if aa_mass is None or aa_mass is mass.std_aa_mass:
+            return None
+        # built from the contents on every call, so tables edited in place
+        # get a new key and no table outlives the entries that use it
+        return frozenset(aa_mass.items())
+
+    def _get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def ladder(self, peptide, types=("b", "y"), max_charge=1, aa_mass=None):
+        """
+        Fragment ladder of one peptide, see fragment_ladders.
+
+        returns dict of read-only np.arrays without the peptide and offsets
+        entries
+        """
+        types = tuple(types)
+        key = ("ladder", peptide, self._mods_key(aa_mass), types, max_charge)
+        value = self._get(key)
+        if value is None:
+            value = self._store_ladders([peptide], [key], types, max_charge, aa_mass)[0]
+        return value
+
+    def ladders(self, peptides, types=("b", "y"), max_charge=1, aa_mass=None):
+        """
+        Fragment ladders of many peptides; missing ones are computed
+        together in one fragment_ladders call.
+
+        returns list of dicts, one per peptide, see ladder
+        """
+        types = tuple(types)
+        mods = self._mods_key(aa_mass)
+        values, missing = [], {}
+        for i, peptide in enumerate(peptides):
+            key = ("ladder", peptide, mods, types, max_charge)
+            if key in missing:
+                # repeated in this batch, computed with the first occurrence
+                self.hits += 1
+                missing[key].append(i)
+                values.append(None)
+                continue
+            value = self._get(key)
+            if value is None:
+                missing[key] = [i]
+            values.append(value)
+        if missing:
+            keys = list(missing)
+            computed = self._store_ladders(
+                [key[1] for key in keys], keys, types, max_charge, aa_mass
+            )
+            for key, value in zip(keys, computed):
+                for i in missing[key]:
+                    values[i] = value
+        return values
+
+    def _store_ladders(self, peptides, keys, types, max_charge, aa_mass):
+        """Compute ladders of `peptides` in one call and cache them under `keys`."""
+        ladders = fragment_ladders(peptides, types=types, max_charge=max_charge, aa_mass=aa_mass)
+        offsets = ladders.pop("offsets")
+        ladders.pop("peptide")
+        values = []
+        for key, start, stop in zip(keys, offsets[:-1], offsets[1:]):
+            value = {name: array[start:stop].copy() for name, array in ladders.items()}
+            for array in value.values():
+                array.flags.writeable = False
+            self._put(key, value)
+            values.append(value)
+        return values
+
+    def precursor_mass(self, peptide, charge=None, aa_mass=None):
+        """Monoisotopic mass, or m/z when `charge` is given, see precursor_masses."""
+        key = ("precursor", peptide, self._mods_key(aa_mass), charge)
+        value = self._get(key)
+        if value is None:
+            value = float(precursor_masses([peptide], charge, aa_mass)[0])
+            self._put(key, value)
+        return value
+
+    def stats(self):
+        """
+        Hit/miss statistics of the cache.
+
+        returns dict with entries, max_entries, hits, misses, hit_rate,
+        evictions and nbytes (bytes of the cached arrays)
+        """
+        lookups = self.hits + self.misses
+        nbytes = sum(
+            sum(array.nbytes for array in value.values())
+            for value in self._entries.values()
+            if isinstance(value, dict)
+        )
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "nbytes": nbytes,
+        }
+
+    def clear(self):
+        """Drop every entry and reset the statistics."""
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+# cache shared by fragments() and the annotation helpers
+mass_cache = MassCache()
@@ -3,11 +3,15 @@ import pandas as pd
 import altair as alt
 import matplotlib.pyplot as plt 
 from scipy.ndimage import gaussian_filter
-from scipy.signal import argrelextrema
-from pyteomics import mass
+
+from ms_fragments import fragments
+from my_mzml import prof_to_cent
+from ms_annotation import annotate_spectrum, ions_from_dict
+from ms_downsample import MAX_POINTS, downsample, downsample_frame
 
 def smooth_chrom(
-    xs=[], ys=[], smooth_factor=1, source=None, filename=None, save_as=None
+    xs=[], ys=[], smooth_factor=1, source=None, filename=None, save_as=None,
+    max_points=MAX_POINTS,
 ):
     """
     Function to smooth chromatogram from MS data.
@@ -19,6 +23,9 @@ def smooth_chrom(
         None --> implies data is passed as an argument
         'clip' --> implies pandas should read data from clipboard
         'excel' --> implies pandas should read data from excel file
+    :param max_points: (int) point budget of the plotted trace; smoothing runs
+        on all points and longer traces are min/max downsampled,
+        see ms_downsample. None plots every point
     """
     if source is None:
         asrt_text = "If no source is provided, data arrays must be passed as arguments"
@@ -33,6 +40,7 @@ def smooth_chrom(
     xs = df.iloc[3:, 0].astype(float)
     ys = df.iloc[3:, 1].astype(float)
     ys = gaussian_filter(ys, smooth_factor)
+    xs, ys = downsample(xs, ys, max_points)
     plt.plot(xs, ys)
     plt.fill_between(xs, ys, alpha=0.3)
     if save_as:
@@ -40,7 +48,8 @@ def smooth_chrom(
 
 
 def plot_ms2_data(
-    xs, ys, peptide, frag_dict, mods=None, show_error=False, tolerance=25
+    xs, ys, peptide, frag_dict, mods=None, show_error=False, tolerance=25,
+    max_points=MAX_POINTS,
 ):
     """
     Function to return altair plot of identified fragments for a theoretical
@@ -49,19 +58,16 @@ def plot_ms2_data(
     :param xs: (array) x/time data
     :param ys: (array) intensity data
     :param peptide: (string) peptide sequence
-    :param frag_dict: (dict) output returned from data_processing.fragments func
+    :param frag_dict: (dict) output returned from ms_fragments.fragments func
+    :param mods: (dict) other ions {name: m/z or list of m/z} to annotate
+    :param tolerance: (float) ppm tolerance of annotation
+    :param max_points: (int) point budget of the drawn peaks, see
+        ms_downsample. None draws every annotated peak
+
+    Peaks are matched with ms_annotation.annotate_spectrum and only the
+    annotated peaks are drawn.
     """
-    # handle -endian order of data
-    data = [xs, ys]
-    for i, array in enumerate(data):
-        if array.dtype.byteorder == ">":  # is big-endian
-            data[i] = data[i].byteswap().newbyteorder()
-    xs, ys = data
-
-    df = pd.DataFrame(
-        {"x": xs, "y": ys, "fragment": [None] * len(xs), "label": [""] * len(xs)}
-    )
-
+    frag_dict = dict(frag_dict)
     if mods is not None:
         assert isinstance(mods, dict), "modifications must enter as dictionary"
         for k in mods:
@@ -84,28 +90,19 @@ def plot_ms2_data(
         "Hex-18": "#3d8f2e",
     }
 
-    err_mass, err_dist, err_kind = [], [], []
-
-    for k, v in frag_dict.items():
-        for frag in v:
-            nearest = find_nearest(df.x, frag)
-            error = mass_error(frag, nearest)
-            if abs(error) <= tolerance:
-                err_mass.append(nearest)
-                err_dist.append(error)
-                err_kind.append(k)
-                df.loc[(df.x == nearest), "fragment"] = k
-                if k in ["b"]:
-                    df.loc[(df.x == nearest), "label"] = k + f"{v.index(frag)+1}"
-                elif k in ["y"]:
-                    df.loc[(df.x == nearest), "label"] = (
-                        k + f"{len(v) - v.index(frag)+1}"
-                    )
-                else:
-                    df.loc[(df.x == nearest), "label"] = k
-
-    df.dropna(inplace=True)
+    matches = annotate_spectrum(
+        xs, ys, ions_from_dict(frag_dict, peptide), tolerance=tolerance
+    )
+    # a peak matched by several ions is labeled with the last one
+    peaks = matches.drop_duplicates("peak", keep="last").sort_values("observed_mz")
+    df = pd.DataFrame({
+        "x": peaks.observed_mz.to_numpy(),
+        "y": peaks.intensity.to_numpy(),
+        "fragment": peaks.ion_type.to_numpy(),
+        "label": peaks.label.to_numpy(),
+    })
     df.loc[:, "y"] = df.y / np.max(df.y) * 100
+    df = downsample_frame(df, "x", "y", max_points=max_points)
     df["label position"] = df.y + 5
 
     bars = (
@@ -136,7 +133,11 @@ def plot_ms2_data(
     chart = alt.vconcat()
     chart &= alt.layer(bars, text)
     if show_error:
-        err_df = pd.DataFrame({"mass": err_mass, "error": err_dist, "kind": err_kind})
+        err_df = pd.DataFrame({
+            "mass": matches.observed_mz,
+            "error": matches.ppm_error,
+            "kind": matches.ion_type,
+        })
         dots = (
             alt.Chart(err_df)
             .mark_circle()
@@ -166,44 +167,6 @@ def plot_ms2_data(
     return chart.configure_view(strokeWidth=0)
 
 
-def fragments(peptide, types=("b", "y"), max_charge=1):
-    """
-    Function that returns theoretical fragments of peptide.
-    Modeled from : https://pyteomics.readthedocs.io/en/latest/examples/example_msms.html
-
-    :param peptide: (str) peptide sequence
-    :param types: (tuple) types of fragments desired
-    :param max_charge: (int) maximum charge state of fragment ions
-    """
-    d = {}
-    for ion_type in types:
-        d[ion_type] = []
-        for i in range(1, len(peptide)):
-            for charge in range(1, max_charge + 1):
-                if ion_type[0] in "abc":
-                    if i == 0:
-                        continue
-                    m = mass.fast_mass(peptide[:i], ion_type=ion_type, charge=charge)
-                else:
-                    m = mass.fast_mass(peptide[i:], ion_type=ion_type, charge=charge)
-                d[ion_type].append(m)
-    return d
-
-
-def prof_to_cent(xs, ys):
-    """
-    Function to turn profile data to centroid.
-    Collects relative maximums and uses indexes of those
-    maximums to decipher xs and ys arrays.
-
-    :param xs: (array) array of x data
-    :param ys: (array) array of y data
-    """
-    idx = argrelextrema(ys, np.greater)
-    xs, ys = xs[idx], ys[idx]
-    return xs, ys
-
-
 def mass_error(m1: float, m2: float):
     """
     Caluclates the ppm error between two masses.
@@ -1,185 +1,1670 @@
+import io
+import os
+import re
+import zlib
+import json
+import base64
+import time
+import shutil
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 plt.rcParams["axes.formatter.useoffset"] = False
-from scipy.signal import argrelextrema
+from lxml import etree
 import pyteomics
-from pyteomics import auxiliary, mass, mzxml
+from pyteomics import auxiliary, mass, mzml, mzxml
+
+from ms_fragments import fragments
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 ###############################################################################
 
+STORE_VERSION = 3
+
+# share of a run's scans above which get_scans builds the store instead of
+# seeking scan by scan through the offset index
+BULK_READ_FRACTION = 0.2
+
+logger = logging.getLogger(__name__)
+
+# columns of the scan header table: dtype and value when the file omits it
+HEADER_COLUMNS = {
+    "scan": (np.int64, 0),
+    "ms_level": (np.int8, 0),
+    "rt": (np.float64, np.nan),
+    "peaks_count": (np.int64, 0),
+    "centroided": (bool, False),
+    "polarity": (object, ""),
+    "tic": (np.float64, np.nan),
+    "bpi": (np.float64, np.nan),
+    "bpi_mz": (np.float64, np.nan),
+    "low_mz": (np.float64, np.nan),
+    "high_mz": (np.float64, np.nan),
+    "n_precursors": (np.int8, 0),
+    "precursor_mz": (np.float64, np.nan),
+    "precursor_charge": (np.int8, 0),
+    "precursor_intensity": (np.float64, np.nan),
+    "isolation_width": (np.float64, np.nan),
+    "precursor_scan": (np.int64, 0),
+    "activation": (object, ""),
+}
+
+# mzML cvParam accessions of the header values
+MZML_HEADER_ACCESSIONS = {
+    "MS:1000511": "ms_level",
+    "MS:1000016": "rt",
+    "MS:1000285": "tic",
+    "MS:1000505": "bpi",
+    "MS:1000504": "bpi_mz",
+    "MS:1000528": "low_mz",
+    "MS:1000527": "high_mz",
+    "MS:1000744": "precursor_mz",
+    "MS:1000041": "precursor_charge",
+    "MS:1000042": "precursor_intensity",
+    "MS:1000828": "isolation_lower",
+    "MS:1000829": "isolation_upper",
+}
+MZML_ACTIVATIONS = {
+    "MS:1000133": "CID",
+    "MS:1000422": "HCD",
+    "MS:1000598": "ETD",
+    "MS:1002631": "EThcD",
+}
+
+
+class ScanStore:
+    """
+    Columnar container for every scan of a run.
+
+    Peaks of all scans live in two flat arrays (m/z, intensity); scan i owns
+    the slice offsets[i]:offsets[i+1] and its peaks are sorted by m/z. Scan
+    headers are held as parallel arrays and precursors as a separate table
+    keyed by scan position, so multiplexed MS2 scans keep all of their
+    precursors with the m/z bounds of their isolation window (nan when the
+    file does not record it). Total ion current, base peak intensity and base peak m/z of
+    every scan are computed once when the store is built.
+
+    Stores are saved as a directory of .npy files and memory-mapped on load.
+    """
+
+    scan_columns = ("scan_num", "rt", "ms_level", "offsets")
+    peak_columns = ("mz", "intensity")
+    precursor_columns = (
+        "prec_scan", "prec_mz", "prec_charge", "prec_intensity", "prec_lower", "prec_upper"
+    )
+    summary_columns = ("tic", "bpi", "bpi_mz")
+
+    def __init__(self, meta=None, **arrays):
+        self.meta = dict(meta or {})
+        for name in ("prec_lower", "prec_upper"):
+            if name not in arrays:
+                arrays[name] = np.full(arrays["prec_mz"].shape[0], np.nan)
+        if any(name not in arrays for name in self.summary_columns):
+            arrays.update(
+                _summary_columns(arrays["mz"], arrays["intensity"], arrays["offsets"])
+            )
+        for name in self.columns():
+            setattr(self, name, arrays[name])
+
+    def __repr__(self):
+        return f"ScanStore with {self.n_scans} scans and {self.mz.shape[0]} peaks"
+
+    @classmethod
+    def columns(cls):
+        return (
+            cls.scan_columns + cls.summary_columns + cls.peak_columns + cls.precursor_columns
+        )
+
+    @property
+    def n_scans(self):
+        return self.rt.shape[0]
+
+    def nbytes(self):
+        """
+        Size of every column.
+
+        returns dict of column name: bytes
+        """
+        return {name: getattr(self, name).nbytes for name in self.columns()}
+
+    def peaks(self, position):
+        """Return the m/z and intensity views of the scan at `position`."""
+        start, stop = self.offsets[position], self.offsets[position + 1]
+        return self.mz[start:stop], self.intensity[start:stop]
+
+    def save(self, path):
+        """
+        Write store to directory `path` as one .npy file per column.
+
+        :arg path:  (str)   directory that will hold the store
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.columns():
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        # meta is written last so a partially written store is never valid
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Open store saved in directory `path`. Columns are memory-mapped
+        unless `mmap_mode` is None.
+        """
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in cls.columns()
+        }
+        return cls(meta=meta, **arrays)
+
+    @classmethod
+    def concatenate(cls, stores, meta=None):
+        """
+        Join stores holding consecutive parts of the same run.
+
+        :arg stores:    (list)  ScanStore objects in scan order
+        """
+        scan_shift = np.cumsum([0] + [s.n_scans for s in stores[:-1]])
+        peak_shift = np.cumsum([0] + [s.mz.shape[0] for s in stores[:-1]])
+
+        arrays = {}
+        for name in cls.columns():
+            parts = [getattr(s, name) for s in stores]
+            if name == "offsets":
+                parts = [parts[0]] + [
+                    p[1:] + shift for p, shift in zip(parts[1:], peak_shift[1:])
+                ]
+            elif name == "prec_scan":
+                parts = [p + shift for p, shift in zip(parts, scan_shift)]
+            arrays[name] = np.concatenate(parts)
+        return cls(meta=meta, **arrays)
+
+    @classmethod
+    def from_scans(cls, scans, meta=None, mz_dtype=None, intensity_dtype=np.float32,
+                   stats=None):
+        """
+        Build store from an iterable of Scan objects as yielded by
+        mzXML.scans.
+
+        :arg scans:             (iterable)  Scan objects in scan order
+        :arg meta:              (dict) <optional>   metadata saved with the store
+        :arg mz_dtype:          (np.dtype)  dtype of the flat m/z array, None
+                                            keeps the decoded precision
+        :arg intensity_dtype:   (np.dtype)  dtype of the flat intensity array
+        :arg stats:             (IngestStats) <optional>    receives the time
+                                spent pulling scans from `scans` (parse),
+                                decoding peak arrays and assembling the store
+        """
+        if stats is None:
+            stats = IngestStats()
+        clock = time.perf_counter
+        scan_num, rt, ms_level, lengths = [], [], [], []
+        mz, intensity = [], []
+        prec_scan, prec_mz, prec_charge, prec_intensity = [], [], [], []
+        prec_lower, prec_upper = [], []
+
+        scans = iter(scans)
+        position = 0
+        while True:
+            tick = clock()
+            scan = next(scans, None)
+            tock = clock()
+            stats.add("parse", tock - tick)
+            if scan is None:
+                break
+            masses, ints = scan.mz, scan.intensity
+            tick = clock()
+            stats.add("decode", tick - tock)
+            if np.any(masses[1:] < masses[:-1]):
+                order = np.argsort(masses, kind="stable")
+                masses, ints = masses[order], ints[order]
+            scan_num.append(scan.scan_num)
+            rt.append(scan.rt)
+            ms_level.append(scan.ms_level)
+            lengths.append(masses.shape[0])
+            mz.append(masses)
+            intensity.append(ints)
+            for p_mz, p_charge, p_int, p_lower, p_upper in scan.precursors:
+                prec_scan.append(position)
+                prec_mz.append(p_mz)
+                prec_charge.append(p_charge)
+                prec_intensity.append(p_int)
+                prec_lower.append(p_lower)
+                prec_upper.append(p_upper)
+            position += 1
+            stats.add("assemble", clock() - tick)
+            stats.count(1, masses.shape[0], masses.nbytes + ints.nbytes)
+
+        tick = clock()
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        store = cls(
+            meta=meta,
+            scan_num=np.array(scan_num, dtype=np.int64),
+            rt=np.array(rt, dtype=np.float64),
+            ms_level=np.array(ms_level, dtype=np.int8),
+            offsets=offsets,
+            mz=_concat(mz, mz_dtype),
+            intensity=_concat(intensity, intensity_dtype),
+            prec_scan=np.array(prec_scan, dtype=np.int64),
+            prec_mz=np.array(prec_mz, dtype=np.float64),
+            prec_charge=np.array(prec_charge, dtype=np.int8),
+            prec_intensity=np.array(prec_intensity, dtype=np.float64),
+            prec_lower=np.array(prec_lower, dtype=np.float64),
+            prec_upper=np.array(prec_upper, dtype=np.float64),
+        )
+        stats.add("assemble", clock() - tick)
+        return store
+
+
+class IngestStats:
+    """
+    Stage timers and counters of one ingestion.
+
+    Building a store is split into the stages
+        parse:      XML parsing of scan headers (pyteomics)
+        decode:     base64/zlib decoding of the peak arrays
+        assemble:   sorting, concatenation and summary columns
+        save, load: writing and memory-mapping the store
+    and every scan adds its peaks and decoded bytes to the counters.
+
+    Events are passed as report dicts to `callback` and to the module
+    logger: "progress" every `every` scans, "stage" at the end of save and
+    load, and "done" once the store is ready. Configure
+    logging.getLogger("my_mzml") to record them.
+    """
+
+    stages = ("parse", "decode", "assemble", "save", "load")
+
+    def __init__(self, callback=None, every=1000, total=None):
+        """
+        :arg callback:  (callable) <optional>   called with the report dict
+                                                of every event
+        :arg every:     (int)   scans between progress events
+        :arg total:     (int) <optional>        expected number of scans,
+                                                reported as progress fraction
+        """
+        self.callback = callback
+        self.every = every
+        self.total = total
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.scans = 0
+        self.peaks = 0
+        self.bytes_decoded = 0
+        self.workers_peak_memory = 0
+        self._start = time.perf_counter()
+        self._stop = None
+
+    def __repr__(self):
+        return f"IngestStats of {self.scans} scans in {self.elapsed():.2f} s"
+
+    def add(self, stage, seconds):
+        """Add `seconds` to the timer of `stage`."""
+        self.seconds[stage] += seconds
+
+    def count(self, n_scans, n_peaks, n_bytes):
+        """Count decoded scans; emits a progress event every `every` scans."""
+        before = self.scans // self.every
+        self.scans += n_scans
+        self.peaks += n_peaks
+        self.bytes_decoded += n_bytes
+        if self.scans // self.every > before:
+            self.emit("progress")
+
+    def merge(self, report):
+        """Add the timers and counters of a report made in another process."""
+        for stage in self.stages:
+            self.seconds[stage] += report[f"{stage}_s"]
+        self.workers_peak_memory = max(self.workers_peak_memory, report["peak_memory_bytes"])
+        self.count(report["scans"], report["peaks"], report["bytes_decoded"])
+
+    def elapsed(self):
+        """Seconds since the ingestion started, frozen once it is done."""
+        return (self._stop or time.perf_counter()) - self._start
+
+    @staticmethod
+    def peak_memory():
+        """Peak resident memory of this process in bytes, 0 if unknown."""
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+    def report(self, event=None, stage=None):
+        """
+        Current state of the ingestion.
+
+        returns dict with event, stage, elapsed_s, one <stage>_s timer per
+        stage, scans, total, fraction, peaks, bytes_decoded, scans_per_s,
+        decoded_mb_per_s and peak_memory_bytes
+        """
+        elapsed = self.elapsed()
+        decode = self.seconds["decode"]
+        report = {"event": event, "stage": stage, "elapsed_s": elapsed}
+        report.update({f"{name}_s": value for name, value in self.seconds.items()})
+        report.update({
+            "scans": self.scans,
+            "total": self.total,
+            "fraction": self.scans / self.total if self.total else None,
+            "peaks": self.peaks,
+            "bytes_decoded": self.bytes_decoded,
+            "scans_per_s": self.scans / elapsed if elapsed > 0 else 0.0,
+            "decoded_mb_per_s": self.bytes_decoded / 1e6 / decode if decode > 0 else 0.0,
+            "peak_memory_bytes": max(self.peak_memory(), self.workers_peak_memory),
+        })
+        return report
+
+    def emit(self, event, stage=None):
+        """Send the current report to the callback and the logger."""
+        if event == "done":
+            self._stop = time.perf_counter()
+        report = self.report(event, stage)
+        if self.callback is not None:
+            self.callback(report)
+        level = logging.DEBUG if event == "progress" else logging.INFO
+        logger.log(
+            level, "%s%s: %d scans, %.1f scans/s, %.1f MB decoded",
+            event, f" {stage}" if stage else "", report["scans"],
+            report["scans_per_s"], report["bytes_decoded"] / 1e6,
+        )
+        return report
+
+
+class StoreCache:
+    """
+    Directory of ScanStores shared between sessions.
+
+    Entries are keyed by the absolute path, size and mtime of the source file,
+    so an edited or replaced file never hits a stale entry. The cache is kept
+    under `max_bytes` by evicting the least recently used entries.
+    """
+
+    def __init__(self, directory, max_bytes=50e9):
+        """
+        :arg directory: (str)   cache directory, created if missing
+        :arg max_bytes: (float) size bound of the whole cache in bytes
+        """
+        self.directory = f"{directory}"
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"StoreCache in {self.directory} ({len(self.entries())} runs)"
+
+    def key(self, meta):
+        """Cache key of a source identity as returned by mzXML._source_meta."""
+        text = json.dumps(meta, sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, meta):
+        """
+        Return cached store for `meta`, or None. A hit marks the entry as
+        most recently used.
+        """
+        path = os.path.join(self.directory, self.key(meta))
+        try:
+            store = ScanStore.load(path)
+        except (OSError, ValueError):
+            return None
+        if store.meta != meta:
+            return None
+        os.utime(os.path.join(path, "meta.json"))
+        return store
+
+    def put(self, store):
+        """
+        Write `store` to the cache, drop stale entries of the same source
+        and evict down to max_bytes.
+
+        returns the memory-mapped store read back from the cache
+        """
+        meta = store.meta
+        path = os.path.join(self.directory, self.key(meta))
+
+        # write next to the final location and rename, so readers never
+        # see a partially written entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        store.save(tmp_path)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+        for entry in self.entries():
+            if entry["source"] == meta.get("source") and entry["key"] != self.key(meta):
+                shutil.rmtree(os.path.join(self.directory, entry["key"]), ignore_errors=True)
+        self.evict(keep=self.key(meta))
+        return ScanStore.load(path)
+
+    def entries(self):
+        """
+        List cached runs.
+
+        returns list of dicts with key, source, bytes and last_used
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            meta_path = os.path.join(self.directory, key, "meta.json")
+            if not os.path.isfile(meta_path):
+                continue
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            entry_dir = os.path.join(self.directory, key)
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, name))
+                for name in os.listdir(entry_dir)
+            )
+            entries.append({
+                "key": key,
+                "source": meta.get("source"),
+                "bytes": size,
+                "last_used": os.path.getmtime(meta_path),
+            })
+        return entries
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_bytes."""
+        entries = sorted(self.entries(), key=lambda e: e["last_used"])
+        total = sum(e["bytes"] for e in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry["key"] == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, entry["key"]), ignore_errors=True)
+            total -= entry["bytes"]
+
+    def clear(self):
+        """Remove every entry."""
+        for entry in self.entries():
+            shutil.rmtree(os.path.join(self.directory, entry["key"]), ignore_errors=True)
+
+
+class FragmentIndex:
+    """
+    Inverted index of the fragment peaks of a run.
+
+    Every MS2 peak becomes a posting (m/z, scan position, intensity).
+    Postings are grouped in m/z bins of `bin_width` and sorted by scan
+    within each bin, under one sorted key (bin * n_scans + scan). A
+    tolerance query reads the contiguous postings of the bins it covers;
+    a query restricted to a scan range (e.g. an RT window) finds that range
+    inside every bin with two binary searches, so its work grows with the
+    window instead of the run.
+    """
+
+    _arrays = ("mz", "scan", "intensity", "key", "positions")
+
+    def __init__(self, store, positions=None, bin_width=0.05):
+        """
+        :arg store:     (ScanStore) run to index
+        :arg positions: (np.array) <optional>   scan positions to index,
+                                                all MS2 scans by default
+        :arg bin_width: (float) m/z width of the posting bins; a ppm window
+                                usually spans one to three bins
+        """
+        if positions is None:
+            positions = np.flatnonzero(store.ms_level == 2)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.bin_width = bin_width
+        self.stride = max(int(store.n_scans), 1)
+
+        index, segments = _ragged_index(store.offsets, self.positions)
+        mz = np.asarray(store.mz[index])
+        scan = self.positions[segments]
+        key = np.floor(mz.astype(np.float64) / bin_width).astype(np.int64) * self.stride + scan
+        order = np.argsort(key, kind="stable")
+        self.key = key[order]
+        self.mz = mz[order]
+        self.scan = scan[order].astype(np.int32)
+        self.intensity = np.asarray(store.intensity[index])[order]
+
+    def __repr__(self):
+        return f"FragmentIndex of {self.positions.shape[0]} scans and {self.mz.shape[0]} postings"
+
+    def query(self, search_masses, tolerance=20, scan_range=None):
+        """
+        Find the postings of every ion within `tolerance` ppm.
+
+        :arg search_masses: (array-like)    fragment m/z values
+        :arg tolerance:     (float, array-like) ppm tolerance
+        :arg scan_range:    (tuple) <optional>  (first, last) scan position;
+                                                only postings of scans in
+                                                between are read
+
+        returns ion number, scan position and intensity of every hit (np.arrays)
+        """
+        targets = np.atleast_1d(np.asarray(search_masses, dtype=np.float64))
+        tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.float64), targets.shape)
+        lows = targets - targets * tolerance / 1e6
+        highs = targets + targets * tolerance / 1e6
+        first_bin = np.floor(lows / self.bin_width).astype(np.int64)
+        last_bin = np.floor(highs / self.bin_width).astype(np.int64)
+
+        if scan_range is None:
+            # all scans: the bins of an ion are one contiguous run of postings
+            starts = np.searchsorted(self.key, first_bin * self.stride, side="left")
+            stops = np.searchsorted(self.key, (last_bin + 1) * self.stride, side="left")
+            index, ions = _range_index(starts, stops)
+        else:
+            # one scan range per (ion, bin)
+            bins, pair_ion = _range_index(first_bin, last_bin + 1)
+            starts = np.searchsorted(self.key, bins * self.stride + scan_range[0], side="left")
+            stops = np.searchsorted(self.key, bins * self.stride + scan_range[1], side="right")
+            index, pairs = _range_index(starts, stops)
+            ions = pair_ion[pairs]
+
+        # edge bins hold postings outside the tolerance
+        mz = self.mz[index]
+        hit = (mz >= lows[ions]) & (mz <= highs[ions])
+        index, ions = index[hit], ions[hit]
+        return ions, self.scan[index], self.intensity[index]
+
+    def traces(self, search_masses, tolerance=20, positions=None):
+        """
+        Pseudo-EICs of every ion over the indexed scans.
+
+        :arg positions: (np.array) <optional>   sorted subset of the indexed
+                                                scan positions, e.g. an RT
+                                                window; only postings between
+                                                its first and last scan are
+                                                read
+
+        returns intensities (np.array, ions x scans) holding the most
+        intense posting of each ion in each scan
+        """
+        scan_range = None
+        if positions is None:
+            positions = self.positions
+        elif positions.shape[0]:
+            scan_range = (positions[0], positions[-1])
+        n_ions = np.atleast_1d(search_masses).shape[0]
+        ions, scans, ints = self.query(search_masses, tolerance=tolerance, scan_range=scan_range)
+        columns = np.searchsorted(positions, scans)
+        keep = columns < positions.shape[0]
+        keep[keep] = positions[columns[keep]] == scans[keep]
+        ys = np.zeros((n_ions, positions.shape[0]))
+        np.maximum.at(ys, (ions[keep], columns[keep]), ints[keep])
+        return ys
+
+
+class RTIndex:
+    """
+    Retention time lookup of the scans of one msLevel.
+
+    Scan positions are kept sorted by retention time, so the scans of a
+    window are found with two binary searches and the work of a windowed
+    query grows with the window instead of the run.
+    """
+
+    _arrays = ("rt", "positions")
+
+    def __init__(self, store, ms_level=None):
+        """
+        :arg store:     (ScanStore) run to index
+        :arg ms_level:  (int) <optional>    msLevel to index, all scans by default
+        """
+        self.ms_level = ms_level
+        if ms_level is None:
+            positions = np.arange(store.n_scans, dtype=np.int64)
+        else:
+            positions = np.flatnonzero(store.ms_level == ms_level)
+        rt = np.asarray(store.rt[positions], dtype=np.float64)
+        order = np.argsort(rt, kind="stable")
+        self.rt = rt[order]
+        self.positions = positions[order]
+
+    def __repr__(self):
+        level = "all" if self.ms_level is None else f"MS{self.ms_level}"
+        return f"RTIndex of {self.positions.shape[0]} {level} scans"
+
+    def window(self, rt_range=None):
+        """
+        Scan positions with retention time inside `rt_range`.
+
+        :arg rt_range:  (tuple) <optional>  (low, high) retention time,
+                                            inclusive; every scan when None
+
+        returns scan positions in store order (np.array)
+        """
+        if rt_range is None:
+            return np.sort(self.positions)
+        low, high = rt_range
+        start = np.searchsorted(self.rt, low, side="left")
+        stop = np.searchsorted(self.rt, high, side="right")
+        return np.sort(self.positions[start:stop])
+
+
+class Scan:
+    """
+    Single scan yielded by mzXML.scans.
+
+    Peak arrays may be handed over still encoded; they are decoded on first
+    access so that filtering on header values never touches the payload.
+    """
+
+    __slots__ = ("scan_num", "rt", "ms_level", "precursors", "_mz", "_intensity")
+
+    def __init__(self, scan_num, rt, ms_level, mz, intensity, precursors=()):
+        self.scan_num = scan_num
+        self.rt = rt
+        self.ms_level = ms_level
+        self.precursors = precursors
+        self._mz = mz
+        self._intensity = intensity
+
+    def __repr__(self):
+        return f"Scan {self.scan_num} (MS{self.ms_level}, {self.rt:.3f} min)"
+
+    @property
+    def mz(self):
+        if not isinstance(self._mz, np.ndarray):
+            self._decode()
+        return self._mz
+
+    @property
+    def intensity(self):
+        if not isinstance(self._intensity, np.ndarray):
+            self._decode()
+        return self._intensity
+
+    def _decode(self):
+        """
+        Decode the peak arrays still encoded. A payload holding both arrays
+        (mzXML <peaks>) is handed over as both of them and decoded once.
+        """
+        if self._mz is self._intensity:
+            self._mz, self._intensity = self._mz.decode()
+            return
+        if not isinstance(self._mz, np.ndarray):
+            self._mz = self._mz.decode()
+        if not isinstance(self._intensity, np.ndarray):
+            self._intensity = self._intensity.decode()
+
+    @property
+    def precursor_mz(self):
+        """m/z of the first precursor, None for MS1 scans"""
+        return self.precursors[0][0] if self.precursors else None
+
+
+class _Peaks:
+    """
+    Encoded <peaks> payload of one mzXML scan. m/z and intensity values are
+    interleaved in it, so one decode yields both arrays.
+    """
+
+    __slots__ = ("payload", "compressed", "dtype")
+
+    def __init__(self, payload, compressed, dtype):
+        self.payload = payload
+        self.compressed = compressed
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_attrs(cls, payload, attrs):
+        """Payload with the precision, byte order and compression of `attrs`."""
+        order = ">" if attrs.get("byteOrder", "network") in ("network", "big") else "<"
+        precision = "f8" if attrs.get("precision") == "64" else "f4"
+        return cls(payload, attrs.get("compressionType") == "zlib", order + precision)
+
+    def decode(self):
+        """returns m/z and intensity (np.array)"""
+        if not self.payload:
+            empty = np.zeros(0, dtype=self.dtype)
+            return empty, empty.copy()
+        binary = base64.b64decode(self.payload)
+        if self.compressed:
+            binary = zlib.decompress(binary)
+        pairs = np.frombuffer(bytearray(binary), dtype=self.dtype)
+        return pairs[0::2], pairs[1::2]
+
 
 class mzXML:
     """Class representing .raw file for ETL"""
 
     """Class constructed for mzXML data processing"""
 
-    def __init__(self, mz_file):
+    def __init__(self, mz_file, use_store=True, lazy=False, workers=1, cache=None,
+                 mz_dtype=None, intensity_dtype=np.float32, progress=None):
+        """
+        :arg mz_file:   (str)   path to .mzXML file
+        :arg use_store: (bool)  when True, the decoded run is written once to a
+                                columnar store next to the source file and
+                                memory-mapped on later opens
+        :arg lazy:      (bool)  when True, nothing is decoded up front. Use
+                                self.scans for streaming queries. Until the
+                                store exists, methods called with rt_range
+                                stream only the scans of that window (see
+                                _lazy_window); any other query builds the
+                                store on first use
+        :arg workers:   (int)   number of processes decoding peak arrays
+                                when the store has to be built, at most
+                                one per CPU; serial on a single CPU
+        :arg cache:     (StoreCache, str) <optional>    cache (or its directory)
+                                holding stores of previously opened runs;
+                                used instead of the store next to the source
+        :arg mz_dtype:          (np.dtype) <optional>   dtype of stored m/z
+                                            values; by default the precision
+                                            written in the file (32 or 64 bit)
+        :arg intensity_dtype:   (np.dtype)  dtype of stored intensities; float32
+                                            holds the precision of most
+                                            instruments at half the memory
+        :arg progress:  (callable) <optional>   called with the IngestStats
+                                report of every ingestion event; the final
+                                stats are kept in self.ingest_stats
+        """
         # convert file path to raw string
         self.path_to_file = f"{mz_file}"
-
-        # instantiate ms1 and ms2 data arrays
-        self.ms1_data = None
-        self.ms2_data = None
-
-        # read in data
-        self.data = pyteomics.mzxml.read(self.path_to_file)
+        self.use_store = use_store
+        self.workers = workers
+        self.mz_dtype = None if mz_dtype is None else np.dtype(mz_dtype)
+        self.intensity_dtype = np.dtype(intensity_dtype)
+        if cache is not None and not isinstance(cache, StoreCache):
+            cache = StoreCache(cache)
+        self.cache = cache
+        self.progress = progress
+        self.ingest_stats = None
+        self._store = None
+        self._indexes = {}
 
         # collect data using func(_get_ms_data)
-        self._get_ms_data()
+        if not lazy:
+            self._get_ms_data()
 
     def __repr__(self):
         return f"mzXML object constructed from {self.path_to_file}"
 
+    @classmethod
+    def from_store(cls, store, path_to_file=None):
+        """
+        Construct mzXML object around an existing ScanStore, e.g. one
+        built in memory or loaded from another location.
+        """
+        run = cls.__new__(cls)
+        run.path_to_file = f"{path_to_file}"
+        run.use_store = False
+        run.workers = 1
+        run.cache = None
+        run.mz_dtype = None
+        run.intensity_dtype = np.dtype(np.float32)
+        run.progress = None
+        run.ingest_stats = None
+        run._store = store
+        run._indexes = {}
+        return run
+
+    @property
+    def data(self):
+        """Fresh pyteomics reader over the source file."""
+        return pyteomics.mzxml.read(self.path_to_file, use_index=True)
+
+    @property
+    def store(self):
+        """ScanStore of the run, ingested on first access in lazy mode."""
+        if self._store is None:
+            self._get_ms_data()
+        return self._store
+
+    @property
+    def store_path(self):
+        return self.path_to_file + ".mzstore"
+
+    @property
+    def ms1_data(self):
+        """
+        Nx3 object array of time, precursor_masses and
+        precursor_mass_intensity. Built once from the scan store, with
+        writable copies of the peak arrays.
+        """
+        if "ms1_data" not in self._indexes:
+            store = self.store
+            rows = []
+            for i in np.flatnonzero(store.ms_level == 1):
+                mz, intensity = store.peaks(i)
+                rows.append([store.rt[i], np.array(mz), np.array(intensity)])
+            self._indexes["ms1_data"] = np.array(rows, dtype="object")
+        return self._indexes["ms1_data"]
+
+    @property
+    def ms2_data(self):
+        """
+        Nx5 object array of time, precursor_mass, precursor_charge,
+        fragment_ion_masses and fragment_ion_intensity; one row per precursor.
+        Built once from the scan store, with writable copies of the peak
+        arrays shared by the rows of a multiplexed scan.
+        """
+        if "ms2_data" not in self._indexes:
+            store = self.store
+            peaks = {}
+            rows = []
+            for i, position in enumerate(store.prec_scan):
+                if position not in peaks:
+                    peaks[position] = [np.array(a) for a in store.peaks(position)]
+                charge = int(store.prec_charge[i]) or None
+                rows.append([store.rt[position], store.prec_mz[i], charge, *peaks[position]])
+            self._indexes["ms2_data"] = np.array(rows, dtype="object")
+        return self._indexes["ms2_data"]
+
+    def _source_meta(self):
+        """Identity of the source file used to validate a saved store."""
+        stat = os.stat(self.path_to_file)
+        return {
+            "version": STORE_VERSION,
+            "source": os.path.abspath(self.path_to_file),
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime_ns,
+            "mz_dtype": "source" if self.mz_dtype is None else self.mz_dtype.name,
+            "intensity_dtype": self.intensity_dtype.name,
+        }
+
+    def _load_store(self, meta):
+        """Return saved store if it was built from the current source, else None."""
+        try:
+            store = ScanStore.load(self.store_path)
+        except (OSError, ValueError):
+            return None
+        if store.meta != meta:
+            return None
+        return store
+
+    def _parse_scan(self, scan):
+        """
+        Normalize one pyteomics scan into a Scan. Precursors are kept as a
+        list of (m/z, charge, intensity, window low, window high) tuples; the
+        isolation window is centered on the precursor (windowWideness).
+        """
+        precursors = []
+        if scan["msLevel"] == 2:
+            # iterate in case there are mulitplexed scans
+            for precursor in scan["precursorMz"]:
+                half_width = precursor.get("windowWideness", np.nan) / 2
+                precursors.append(
+                    (
+                        precursor["precursorMz"],
+                        precursor.get("precursorCharge", 0),
+                        precursor.get("precursorIntensity", 0.0),
+                        precursor["precursorMz"] - half_width,
+                        precursor["precursorMz"] + half_width,
+                    )
+                )
+        mz, intensity = scan["m/z array"], scan["intensity array"]
+        if not isinstance(mz, np.ndarray):
+            # both records point at the same <peaks> payload
+            mz = intensity = _Peaks(
+                mz.data, mz.compression == "zlib compression", mz.dtype["m/z array"]
+            )
+        return Scan(
+            int(scan["num"]),
+            scan["retentionTime"],
+            scan["msLevel"],
+            mz,
+            intensity,
+            precursors,
+        )
+
+    def _iter_raw_scans(self):
+        """
+        <generator>
+
+        Yields every scan of the file with its peak arrays left encoded.
+        """
+        return self._iterparse_scans(self.path_to_file)
+
+    def _iterparse_scans(self, source, recover=False):
+        """
+        <generator>
+
+        Reads the scans of `source` (path or file object) with
+        lxml.iterparse like _iter_headers, which skips the type conversion
+        pyteomics applies to every element and attribute, and normalizes
+        them like _parse_scan. A scan is yielded once its <peaks> element is
+        parsed, so nested scans (mzXML 2) follow their parent. `recover`
+        lets a cut out part of the file parse, see _read_scans.
+
+        yields Scan with its peak arrays left encoded
+        """
+        open_scans = []
+        context = etree.iterparse(
+            source,
+            events=("start", "end"),
+            tag=("{*}scan", "{*}precursorMz", "{*}peaks"),
+            huge_tree=True,
+            recover=recover,
+        )
+        for event, elem in context:
+            tag = elem.tag.rpartition("}")[2]
+            if event == "start":
+                if tag == "scan":
+                    attrs = elem.attrib
+                    open_scans.append((
+                        int(attrs["num"]),
+                        _duration_minutes(attrs.get("retentionTime")),
+                        int(attrs.get("msLevel", 0)),
+                        [],
+                    ))
+                continue
+
+            if tag == "precursorMz":
+                scan_num, rt, ms_level, precursors = open_scans[-1]
+                if ms_level == 2:
+                    attrs = elem.attrib
+                    prec_mz = float(elem.text)
+                    half_width = float(attrs.get("windowWideness", np.nan)) / 2
+                    precursors.append((
+                        prec_mz,
+                        int(attrs.get("precursorCharge", 0)),
+                        float(attrs.get("precursorIntensity", 0.0)),
+                        prec_mz - half_width,
+                        prec_mz + half_width,
+                    ))
+            elif tag == "peaks":
+                scan_num, rt, ms_level, precursors = open_scans[-1]
+                peaks = _Peaks.from_attrs(elem.text, elem.attrib)
+                elem.clear()
+                yield Scan(scan_num, rt, ms_level, peaks, peaks, precursors)
+            else:
+                open_scans.pop()
+                elem.clear()
+                # drop finished siblings so memory stays flat
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    def _indexed_reader(self):
+        """pyteomics reader with random access by scan id."""
+        return pyteomics.mzxml.MzXML(self.path_to_file, use_index=True, decode_binary=False)
+
+    def _reader(self):
+        """Indexed reader of the run, opened once; the byte index is built on open."""
+        if "reader" not in self._indexes:
+            self._indexes["reader"] = self._indexed_reader()
+        return self._indexes["reader"]
+
+    def _ordered_ids(self):
+        """Scan ids of the file in the order they are stored in the ScanStore."""
+        offsets = self._reader()._offset_index["scan"]
+        # pyteomics iterates mzXML scans by scan number
+        return sorted(offsets, key=int)
+
+    def _scan_count(self):
+        """
+        Number of scans in the file from its offset index, used as the
+        progress total; None when the file cannot be indexed.
+        """
+        try:
+            return len(self._ordered_ids())
+        except (OSError, KeyError, auxiliary.PyteomicsError):
+            return None
+
+    def _scan_chunks(self, n_chunks):
+        """
+        Split the scan ids of the file into `n_chunks` runs of consecutive
+        scans, using the byte offset index of the file.
+
+        returns list of lists of scan ids
+        """
+        ids = self._ordered_ids()
+        bounds = np.linspace(0, len(ids), n_chunks + 1).astype(int)
+        return [ids[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    def _parallel_store(self, meta, stats, workers):
+        """
+        Build the ScanStore by decoding chunks of scans in a pool of `workers`
+        processes. Stage timers of the workers are summed into `stats`, so
+        they count CPU time of all workers rather than wall time.
+        """
+        # a few chunks per worker keep the pool busy when scan sizes vary
+        chunks = self._scan_chunks(workers * 4)
+        stats.total = sum(len(chunk) for chunk in chunks)
+        parts = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for part, report in pool.map(
+                _decode_chunk,
+                [type(self)] * len(chunks),
+                [self.path_to_file] * len(chunks),
+                chunks,
+                [self.mz_dtype] * len(chunks),
+                [self.intensity_dtype] * len(chunks),
+            ):
+                parts.append(part)
+                stats.merge(report)
+        tick = time.perf_counter()
+        store = ScanStore.concatenate(parts, meta=meta)
+        stats.add("assemble", time.perf_counter() - tick)
+        return store
+
+    def scans(self, ms_level=None, rt_range=None, precursor_range=None):
+        """
+        <generator>
+
+        Streams scans straight from the file. Scans are filtered on their
+        header values and only the ones that pass are decoded, and only
+        when their m/z or intensity arrays are accessed.
+
+        :arg ms_level:          (int) <optional>    keep only this msLevel
+        :arg rt_range:          (tuple) <optional>  (low, high) retention time
+        :arg precursor_range:   (tuple) <optional>  (low, high) precursor m/z,
+                                                    drops scans without precursor
+
+        yields Scan
+        """
+        return _filter_scans(
+            self._iter_raw_scans(), ms_level, rt_range, precursor_range
+        )
+
+    def _window_scans(self, rt_range):
+        """
+        <generator>
+
+        Reads the scans of `rt_range` through the offset index. The first
+        scan of the window is found by bisection on retention time and
+        reading stops at the first scan past it, so the cost follows the
+        size of the window rather than its position in the run. Retention
+        time is taken to increase in scan order.
+
+        yields Scan
+        """
+        low, high = rt_range
+        reader = self._reader()
+        ids = self._ordered_ids()
+
+        def scan_at(i):
+            return self._parse_scan(reader.get_by_id(ids[i]))
+
+        lo, hi = 0, len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if scan_at(mid).rt < low:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, len(ids)):
+            scan = scan_at(i)
+            if scan.rt > high:
+                return
+            yield scan
+
+    def _lazy_window(self, rt_range):
+        """
+        Run holding only the scans of `rt_range`, read with _window_scans,
+        for windowed queries of a lazy run whose store is not built yet.
+
+        returns mzXML object on an in-memory store of the window, or None
+        when there is no window or the store already exists
+        """
+        if rt_range is None or self._store is not None:
+            return None
+        store = ScanStore.from_scans(
+            self._window_scans(rt_range),
+            mz_dtype=self.mz_dtype,
+            intensity_dtype=self.intensity_dtype,
+        )
+        return type(self).from_store(store, self.path_to_file)
+
+    def _iter_headers(self):
+        """
+        <generator>
+
+        Reads scan attributes and precursor elements with lxml.iterparse.
+        Peak payloads are dropped as soon as they are parsed and never
+        decoded. Nested scans (mzXML 2) are yielded before their parent.
+
+        yields dict of header values, see HEADER_COLUMNS
+        """
+        open_scans = []
+        context = etree.iterparse(
+            self.path_to_file,
+            events=("start", "end"),
+            tag=("{*}scan", "{*}precursorMz", "{*}peaks"),
+            huge_tree=True,
+        )
+        for event, elem in context:
+            tag = elem.tag.rpartition("}")[2]
+            if event == "start":
+                if tag == "scan":
+                    attrs = elem.attrib
+                    open_scans.append({
+                        "scan": int(attrs["num"]),
+                        "ms_level": int(attrs.get("msLevel", 0)),
+                        "rt": _duration_minutes(attrs.get("retentionTime")),
+                        "peaks_count": int(attrs.get("peaksCount", 0)),
+                        "centroided": attrs.get("centroided") == "1",
+                        "polarity": attrs.get("polarity", ""),
+                        "tic": float(attrs.get("totIonCurrent", np.nan)),
+                        "bpi": float(attrs.get("basePeakIntensity", np.nan)),
+                        "bpi_mz": float(attrs.get("basePeakMz", np.nan)),
+                        "low_mz": float(attrs.get("lowMz", np.nan)),
+                        "high_mz": float(attrs.get("highMz", np.nan)),
+                        "n_precursors": 0,
+                    })
+                continue
+
+            if tag == "precursorMz":
+                row = open_scans[-1]
+                row["n_precursors"] += 1
+                if row["n_precursors"] == 1:
+                    attrs = elem.attrib
+                    row["precursor_mz"] = float(elem.text)
+                    row["precursor_charge"] = int(attrs.get("precursorCharge", 0))
+                    row["precursor_intensity"] = float(attrs.get("precursorIntensity", np.nan))
+                    row["isolation_width"] = float(attrs.get("windowWideness", np.nan))
+                    row["precursor_scan"] = int(attrs.get("precursorScanNum", 0))
+                    row["activation"] = attrs.get("activationMethod", "")
+            elif tag == "peaks":
+                elem.clear()
+            else:
+                yield open_scans.pop()
+                elem.clear()
+                # drop finished siblings so memory stays flat
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    def headers(self):
+        """
+        Header table of every scan, read without decoding any peaks, see
+        _iter_headers. Multiplexed scans report their first precursor and
+        the number of precursors. Built once per run.
+
+        returns pd.DataFrame with the typed columns of HEADER_COLUMNS, sorted
+        by scan
+        """
+        if "headers" not in self._indexes:
+            self._indexes["headers"] = _header_table(self._iter_headers())
+        return self._indexes["headers"]
+
+    def summary(self):
+        """
+        Run summary from the header table.
+
+        returns dict with scan counts per msLevel, MS2 per MS1, median
+        cycle time (min, between consecutive MS1 scans), RT range,
+        median peaks per scan and precursor counts
+        """
+        headers = self.headers()
+        ms1 = headers.loc[headers.ms_level == 1]
+        ms2 = headers.loc[headers.ms_level == 2]
+        levels = headers.ms_level.value_counts().sort_index()
+        cycle = np.diff(np.sort(ms1.rt.to_numpy()))
+        return {
+            "file": self.path_to_file,
+            "scans": int(headers.shape[0]),
+            "scans_per_level": {int(level): int(n) for level, n in levels.items()},
+            "ms2_per_ms1": ms2.shape[0] / ms1.shape[0] if ms1.shape[0] else np.nan,
+            "cycle_time": float(np.median(cycle)) if cycle.shape[0] else np.nan,
+            "rt_min": float(headers.rt.min()) if headers.shape[0] else np.nan,
+            "rt_max": float(headers.rt.max()) if headers.shape[0] else np.nan,
+            "median_peaks": float(headers.peaks_count.median()) if headers.shape[0] else np.nan,
+            "precursors": int(ms2.precursor_mz.notna().sum()),
+            "unique_precursors": int(ms2.precursor_mz.round(2).nunique()),
+            "charges": {
+                int(charge): int(n)
+                for charge, n in ms2.precursor_charge.value_counts().sort_index().items()
+            },
+        }
+
     def _get_ms_data(self):
         """
-        Extracts the MS1 and MS2 level data from file.
+        Extracts the MS1 and MS2 level data from file into self.store.
 
-        self.ms1_data will be populated as a 3xN multidimensional array that
-        contains time, precursor_masses, and precursor_mass_intensity
+        When a cache is given, or use_store is set, a valid store saved in the
+        cache (or next to the source file) is memory-mapped instead of
+        re-parsing the XML. Otherwise the file is parsed once and, if
+        possible, the store is written for later opens.
 
-        self.ms2_data will be populated as a 5xN multidimensional array that
-        contains time, precursor_mass, precurcor_charge, fragment_ion_masses,
-        and fragment_ion_intensity
+        Stage timings and progress are collected in self.ingest_stats and
+        sent to self.progress, see IngestStats.
 
         returns: None
         """
+        stats = IngestStats(callback=self.progress)
+        meta = self._source_meta()
+        store = None
+        tick = time.perf_counter()
+        if self.cache is not None:
+            store = self.cache.get(meta)
+        elif self.use_store:
+            store = self._load_store(meta)
+        stats.add("load", time.perf_counter() - tick)
+        if store is not None:
+            stats.emit("stage", "load")
 
-        # instantiate return variables
-        ms1_data = []
-        ms2_data = []
-
-        # iterate through each scan
-        # each scan is a dictionary/hash_table
-        for scan in self.data:
-            # retention time, m/z values, and intensity values are found in every scan
-            time = scan["retentionTime"]
-            masses = scan["m/z array"]
-            intensities = scan["intensity array"]
-
-            # sort data into appropriate arrays
-            if scan["msLevel"] == 1:
-                ms1_data.append([time, masses, intensities])
-
-            elif scan["msLevel"] == 2:
-                # first collect additional info
-                precursor_info = scan["precursorMz"]
-                
-                # iterate in case there are mulitplexed scans
-                for precursor in precursor_info:
-                    precursor_mass = precursor["precursorMz"]
-                    precursor_charge = precursor.get("precursorCharge", None)
-
-                    ms2_data.append(
-                        [time, precursor_mass, precursor_charge, masses, intensities]
-                    )
-        masses = np.array(masses)
-        # point class to multidimensional arrays
-        self.ms1_data = np.array(ms1_data, dtype="object")
-        self.ms2_data = np.array(ms2_data, dtype="object")
+        if store is None:
+            # more workers than CPUs only add process overhead
+            workers = min(self.workers, os.cpu_count() or 1)
+            if workers > 1:
+                store = self._parallel_store(meta, stats, workers)
+            else:
+                if self.progress is not None:
+                    # the scan count costs a pass over the file, only made
+                    # when someone follows the progress fraction
+                    stats.total = self._scan_count()
+                store = ScanStore.from_scans(
+                    self._iter_raw_scans(),
+                    meta=meta,
+                    mz_dtype=self.mz_dtype,
+                    intensity_dtype=self.intensity_dtype,
+                    stats=stats,
+                )
+            tick = time.perf_counter()
+            saved = self.cache is not None
+            if self.cache is not None:
+                store = self.cache.put(store)
+            elif self.use_store:
+                # write next to the final location and rename, so runs that
+                # still map the files of a stale store keep valid mappings
+                tmp_path = f"{self.store_path}.{os.getpid()}.tmp"
+                try:
+                    store.save(tmp_path)
+                    shutil.rmtree(self.store_path, ignore_errors=True)
+                    os.replace(tmp_path, self.store_path)
+                    store = ScanStore.load(self.store_path)
+                    saved = True
+                except OSError:
+                    # read-only location, keep the in-memory store
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+            if saved:
+                stats.add("save", time.perf_counter() - tick)
+                stats.emit("stage", "save")
+        self._store = store
+        self.ingest_stats = stats
+        stats.emit("done")
+
+        n_ms1 = int(np.count_nonzero(store.ms_level == 1))
+        n_ms2 = store.prec_scan.shape[0]
+        logger.info("%d MS1 scans and %d MS2 scans collected", n_ms1, n_ms2)
 
-        print(f"{self.ms1_data.shape[0]} MS1 scans and {self.ms2_data.shape[0]} MS2 scans collected")
+    def _export_precursors(self, df, max_len=None, path=None, fmt="csv",
+                           intensities=False, columns=None, header=False):
+        """To be called from func 'get_precursors'. Writes .csv or
+        .parquet file of the precursors identified in mzxml object.
 
-    def _precursor_to_csv(
-        self, precursor_list, max_len=2000, path=None, intensities=False
-    ):
-        """To be called from func 'get_precursors'. Returns .csv
-        file of all precursors identified in mzxml object.
+        By default the .csv keeps its original layout: no header and the
+        precursor mass only, or mass and intensity with `intensities`.
 
         args:
-             - precursor_list (type: list or dict) iterable containing
-               rounded precursor values. Precursor and intensities in dict.
-             - max_len (type: int) value representing number of rows returned
-               from pandas dataframe
-             - path (type: str) path where .csv will be saved
-             - intensities (type: bool) when True, exported dataframe will
-               contain intensity values associated with precursor masses
+             - df (type: pd.DataFrame) precursor table to be written
+             - max_len (type: int) optional number of rows written
+             - path (type: str) path prefix of the file, defaults to the
+               source file
+             - fmt (type: str) "csv" or "parquet"; parquet needs pyarrow
+             - intensities (type: bool) also write the precursor intensity
+             - columns (type: list) columns of `df` to write instead, e.g.
+               list(df.columns) for the whole table
+             - header (type: bool) write column names to the .csv
         """
+        if fmt not in ("csv", "parquet"):
+            raise ValueError(f"Unknown export format {fmt}")
 
         if path is None:
-            path = self.path_to_file.split(".")[0] + "_precursors.csv"
-        else:
-            path = path + "_precursors.csv"
+            path = os.path.splitext(self.path_to_file)[0]
+        path = f"{path}_precursors.{fmt}"
 
-        if isinstance(precursor_list, list):
-            df = pd.DataFrame(precursor_list)
-        elif isinstance(precursor_list, dict):
-            keys = list(precursor_list.keys())
-            vals = list(precursor_list.values())
-            df = pd.DataFrame({"mass": keys, "int": vals})
-
-        df = df.iloc[:max_len, : intensities + 1]
-        df.to_csv(path, index=False, header=False)
-        print(f"...precursors.csv file created in {path}")
+        if columns is None:
+            columns = ["precursor_mz", "intensity"] if intensities else ["precursor_mz"]
+        df = df.loc[:, list(columns)]
+        if max_len is not None:
+            df = df.iloc[:max_len]
+        if fmt == "csv":
+            df.to_csv(path, index=False, header=header)
+        else:
+            df.to_parquet(path, index=False)
+        print(f"...precursors.{fmt} file created in {path}")
 
     def get_tree(self):
         return auxiliary.print_tree(next(self.data))
 
-    def get_precursors(self, decimals=2, by=None):
+    def precursor_table(self):
+        """
+        Typed table of every precursor captured while the run was ingested.
+
+        returns pd.DataFrame with scan, rt, precursor_mz, charge (0 when
+        unknown), intensity and fragments (number of peaks in the MS2 scan)
+        columns
+        """
+        store = self.store
+        positions = np.asarray(store.prec_scan)
+        return pd.DataFrame({
+            "scan": np.asarray(store.scan_num[positions]),
+            "rt": np.asarray(store.rt[positions]),
+            "precursor_mz": np.asarray(store.prec_mz),
+            "charge": np.asarray(store.prec_charge),
+            "intensity": np.asarray(store.prec_intensity),
+            "fragments": np.asarray(store.offsets[positions + 1] - store.offsets[positions]),
+        })
+
+    def isolation_purity(self, isolation_width=None, tolerance=10, n_isotopes=3):
+        """
+        Precursor purity of every MS2 precursor, see isolation_purity.
+
+        returns pd.DataFrame with scan, rt, parent_scan, precursor_mz,
+        charge, window_low, window_high, envelope_intensity,
+        window_intensity and purity columns; one row per precursor
+        """
+        store = self.store
+        result = isolation_purity(
+            store, isolation_width=isolation_width, tolerance=tolerance,
+            n_isotopes=n_isotopes,
+        )
+        positions = np.asarray(store.prec_scan)
+        parents = result.pop("parent")
+        parent_scan = np.zeros(parents.shape[0], dtype=np.int64)
+        parent_scan[parents >= 0] = store.scan_num[parents[parents >= 0]]
+        table = pd.DataFrame({
+            "scan": np.asarray(store.scan_num[positions]),
+            "rt": np.asarray(store.rt[positions]),
+            "parent_scan": parent_scan,
+            "precursor_mz": np.asarray(store.prec_mz),
+            "charge": np.asarray(store.prec_charge),
+        })
+        for name, values in result.items():
+            table[name] = values
+        return table
+
+    def get_precursors(self, decimals=2, by=None, export=True, path=None, max_len=None, fmt="csv",
+                       intensities=False, columns=None, header=False):
         """Function to pull all recognized precursor m/z values with
-        more than 1 fragment.
+        more than 1 fragment. Works on the precursor table of the store,
+        so the file is not read again.
 
         args:
              - decimals (type: int) number of decimal points returned
                from precursor mass
              - by (type: str) structured order of precursor masses.
-               options ['Intensity']"""
+               options [None, 'Intensity']. None sorts by mass,
+               'Intensity' by the most intense observation of each mass
+             - export (type: bool) write the table, see _export_precursors
+             - path, max_len, fmt, intensities, columns, header: passed
+               to _export_precursors
 
-        precursors = []
-        intensities = []
-
-        for x in self.data:
-            if x["msLevel"] == 2:
-                frags = x["m/z array"]
-                # frag_int = x['intensity array']
-                if len(frags) > 1:
-                    precursor = x["precursorMz"][0]["precursorMz"]
-                    precursor = np.round(precursor, decimals)
-                    intensity = x["precursorMz"][0]["precursorIntensity"]
-                    precursors.append(precursor)
-                    intensities.append(intensity)
-        print(f"{len(set(precursors))} precursors collected from {self.path_to_file}")
-        if by == None:
-            precursors = sorted(list(set(precursors)))
-            self._precursor_to_csv(precursors)
-        elif by == "Intensity":
-            d = dict(zip(precursors, intensities))
-            d = dict(sorted(d.items(), key=lambda x: x[1], reverse=True))
-            self._precursor_to_csv(d)
-        return
+        returns pd.DataFrame of unique rounded precursors"""
+        table = self.precursor_table()
+        # first precursor of every scan with more than 1 fragment
+        _, first = np.unique(table.scan.to_numpy(), return_index=True)
+        table = table.iloc[np.sort(first)]
+        table = table[table.fragments.to_numpy() > 1]
+
+        mass = np.round(table.precursor_mz.to_numpy(), decimals)
+        intensity = table.intensity.to_numpy()
+
+        # most intense observation first, then keep one row per rounded mass
+        order = np.lexsort((-intensity, mass))
+        mass, intensity = mass[order], intensity[order]
+        keep = np.ones(mass.shape[0], dtype=bool)
+        keep[1:] = mass[1:] != mass[:-1]
+        table = table.iloc[order[keep]].assign(precursor_mz=mass[keep])
+
+        if by == "Intensity":
+            table = table.iloc[np.argsort(-table.intensity.to_numpy(), kind="stable")]
+        elif by is not None:
+            raise ValueError("Keyword 'by' must be one of [None, 'Intensity']")
+        table = table.reset_index(drop=True)
+
+        print(f"{table.shape[0]} precursors collected from {self.path_to_file}")
+        if export:
+            self._export_precursors(
+                table, max_len=max_len, path=path, fmt=fmt,
+                intensities=intensities, columns=columns, header=header,
+            )
+        return table
 
     def get_scan(self, scan_num):
         """
         Function that returns the m/z and intensity arrays from given scan number.
 
-        :param scan_num: scan index number
+        :param scan_num: scan index number (int) or scan id (str)
 
-        :returns: m/z array, intensity array
+        :returns: m/z array, intensity array; writable copies, the store
+                  itself is read-only (see ScanStore.peaks for views)
         """
-        if isinstance(scan_num, int):
-            scan_num = str(scan_num + 1)
+        if isinstance(scan_num, (int, np.integer)):
+            scan_num = int(scan_num) + 1
         elif isinstance(scan_num, str):
-            pass
-        scan = self.data[scan_num]
-        return scan["m/z array"], scan["intensity array"]
-
-    def base_peak(self):
-        xs, ys = [], []
-        if self.ms1_data is None:
-            for i, scan in enumerate(self.data):
-                if scan["msLevel"] == 1:
-                    xs.append(scan["retentionTime"])
-                    ints = scan["intensity array"]
-                    ys.append(np.max(ints))
-        else:  # ms1 data has already been created
-            data = self.ms1_data.flat
-            xs = data[0::3]
-            ints = data[2::3]
-            for arr in ints:
-                ys.append(np.max(arr))
-        return np.array(xs), np.array(ys)
-    
+            scan_num = int(scan_num)
+        position = self._scan_position(scan_num)
+        mz, intensity = self.store.peaks(position)
+        return np.array(mz), np.array(intensity)
+
+    def get_scans(self, scan_numbers):
+        """
+        Retrieve many scans at once.
+
+        Requests are sorted by their position in the store (or by byte offset
+        in the file when the store has not been built, see lazy) so data is
+        read front to back in one sweep, then returned in request order.
+
+        Without a store, distinct scans are read through the offset index,
+        with one seek per run of scans that follow each other in the file
+        (see _read_scans). That is only faster than ingesting the run for
+        small requests, so a request for more than BULK_READ_FRACTION of the
+        run's scans builds the store first (see lazy) and is served from it.
+
+        :arg scan_numbers:  (array-like)    scan numbers as written in the file
+                                            (mzXML num, scan= of mzML native IDs)
+
+        returns ragged result: offsets (np.array, len(n + 1)), m/z (np.array),
+        intensity (np.array); scan i owns offsets[i]:offsets[i+1]
+        """
+        scan_numbers = np.asarray(scan_numbers, dtype=np.int64)
+        if self._store is None:
+            unique, inverse = np.unique(scan_numbers, return_inverse=True)
+            if unique.shape[0] <= BULK_READ_FRACTION * len(self._reader_ids()):
+                return _ragged_take(*self._read_scans(unique), inverse)
+
+        store = self.store
+        positions = np.searchsorted(store.scan_num, scan_numbers)
+        positions = np.clip(positions, 0, store.n_scans - 1)
+        missing = store.scan_num[positions] != scan_numbers
+        if missing.any():
+            raise KeyError(f"Scans {scan_numbers[missing].tolist()} not found in {self.path_to_file}")
+
+        # read the store front to back
+        order = np.argsort(positions, kind="stable")
+        index, _ = _ragged_index(store.offsets, positions[order])
+        mz_sorted = np.asarray(store.mz[index])
+        int_sorted = np.asarray(store.intensity[index])
+
+        # and hand the scans back in request order
+        lengths = np.asarray(store.offsets[positions + 1] - store.offsets[positions])
+        sorted_starts = np.cumsum(lengths[order]) - lengths[order]
+        starts = np.empty_like(sorted_starts)
+        starts[order] = sorted_starts
+        index, _ = _range_index(starts, starts + lengths)
+
+        offsets = np.zeros(scan_numbers.shape[0] + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return offsets, mz_sorted[index], int_sorted[index]
+
+    def _reader_ids(self):
+        """Map of scan number to the id used by the indexed reader."""
+        if "reader_ids" not in self._indexes:
+            self._indexes["reader_ids"] = {int(i): i for i in self._ordered_ids()}
+        return self._indexes["reader_ids"]
+
+    def _file_order(self):
+        """
+        Reader ids sorted by byte offset, their offsets and rank, and the
+        bytes of the file before its first scan; built once per run.
+        """
+        if "file_order" not in self._indexes:
+            reader = self._reader()
+            file_offsets = reader._offset_index[reader._default_iter_tag]
+            ids = sorted(file_offsets, key=file_offsets.get)
+            starts = [file_offsets[i] for i in ids]
+            with open(self.path_to_file, "rb") as handle:
+                head = handle.read(starts[0]) if starts else b""
+            rank = {scan_id: k for k, scan_id in enumerate(ids)}
+            self._indexes["file_order"] = (starts, rank, head)
+        return self._indexes["file_order"]
+
+    def _chunk_scans(self, data):
+        """
+        <generator>
+
+        Scans of `data`: the head of the file followed by consecutive scans
+        cut out of it, see _read_scans. The cut may end inside an open scan
+        or close a parent scan that is not part of it, so it is parsed in
+        recover mode.
+        """
+        return self._iterparse_scans(io.BytesIO(data), recover=True)
+
+    def _read_scans(self, scan_numbers):
+        """
+        get_scans without a store: fetch scans in byte offset order and
+        decode them together. Scans that follow each other in the file are
+        read with one seek and parsed in one pass behind the head of the
+        file, see _chunk_scans.
+        """
+        reader_ids = self._reader_ids()
+        try:
+            ids = [reader_ids[int(num)] for num in scan_numbers]
+        except KeyError as excp:
+            raise KeyError(f"Scan {excp.args[0]} not found in {self.path_to_file}") from excp
+
+        starts, rank, head = self._file_order()
+        ranks = np.array([rank[scan_id] for scan_id in ids], dtype=np.int64)
+        wanted = np.unique(ranks)
+        found = {}
+        with open(self.path_to_file, "rb") as handle:
+            # runs of requested scans with no other scan between them
+            for run in np.split(wanted, np.flatnonzero(np.diff(wanted) > 1) + 1):
+                if run.shape[0] == 0:
+                    continue
+                first, last = int(run[0]), int(run[-1])
+                handle.seek(starts[first])
+                if last + 1 < len(starts):
+                    chunk = handle.read(starts[last + 1] - starts[first])
+                else:
+                    chunk = handle.read()
+                # zip stops before parsing past the last scan of the run
+                for position, scan in zip(run.tolist(), self._chunk_scans(head + chunk)):
+                    found[position] = scan
+        scans = [found[position] for position in ranks.tolist()]
+
+        lengths = [scan.mz.shape[0] for scan in scans]
+        offsets = np.zeros(len(scans) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        mz = _concat([scan.mz for scan in scans], self.mz_dtype)
+        intensity = _concat([scan.intensity for scan in scans], self.intensity_dtype)
+        return offsets, mz, intensity
+
+    def rt_index(self, ms_level=None):
+        """RTIndex of the scans of `ms_level`, built once per run and level."""
+        key = ("rt", str(ms_level))
+        if key not in self._indexes:
+            self._indexes[key] = RTIndex(self.store, ms_level)
+        return self._indexes[key]
+
+    def _scan_position(self, scan_num):
+        """Position in the store of the scan with id `scan_num`."""
+        position = np.searchsorted(self.store.scan_num, scan_num)
+        if position == self.store.n_scans or self.store.scan_num[position] != scan_num:
+            raise KeyError(f"Scan {scan_num} not found in {self.path_to_file}")
+        return int(position)
+
+    def base_peak(self, ms_level=1, rt_range=None):
+        """
+        Return retention times and base peak intensities of all scans of
+        `ms_level`. Read from the summaries computed at ingestion.
+
+        :arg rt_range:  (tuple) <optional>  (low, high) retention time
+        """
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.base_peak(ms_level, rt_range=rt_range)
+        positions = self.rt_index(ms_level).window(rt_range)
+        return np.asarray(self.store.rt[positions]), np.asarray(self.store.bpi[positions])
+
+    def tic(self, ms_level=1, rt_range=None):
+        """Return retention times and total ion current of all scans of `ms_level`."""
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.tic(ms_level, rt_range=rt_range)
+        positions = self.rt_index(ms_level).window(rt_range)
+        return np.asarray(self.store.rt[positions]), np.asarray(self.store.tic[positions])
+
+    def chromatograms(self, ms_level=1, rt_range=None):
+        """
+        Summary chromatograms of all scans of `ms_level`.
+
+        returns pd.DataFrame with scan, rt, tic, bpi and bpi_mz columns
+        """
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.chromatograms(ms_level, rt_range=rt_range)
+        store = self.store
+        positions = self.rt_index(ms_level).window(rt_range)
+        return pd.DataFrame({
+            "scan": store.scan_num[positions],
+            "rt": store.rt[positions],
+            "tic": store.tic[positions],
+            "bpi": store.bpi[positions],
+            "bpi_mz": store.bpi_mz[positions],
+        })
+
+    def centroid(self, ms_level=None, method="parabolic", noise=0.0, relative=0.0, workers=1):
+        """
+        Centroid the profile scans of the whole run, see centroid_store.
+
+        returns new mzXML object on the centroided store; every search
+        method can be called on it directly
+        """
+        store = centroid_store(
+            self.store, ms_level=ms_level, method=method, noise=noise,
+            relative=relative, workers=workers,
+        )
+        return type(self).from_store(store, self.path_to_file)
+
+    def memory_report(self):
+        """
+        Bytes held by every component of the run: the store columns and
+        any index built on top of it. Memory-mapped columns are paged in by
+        the OS on access, so they only count as resident once read.
+
+        returns pd.DataFrame with component, dtype, length, bytes and
+        mapped columns, plus a total row
+        """
+        rows = []
+        for name in ScanStore.columns():
+            array = getattr(self.store, name)
+            rows.append({
+                "component": name,
+                "dtype": array.dtype.name,
+                "length": array.shape[0],
+                "bytes": array.nbytes,
+                "mapped": isinstance(array, np.memmap),
+            })
+        for key, index in self._indexes.items():
+            for name in getattr(index, "_arrays", ()):
+                array = getattr(index, name)
+                rows.append({
+                    "component": f"{'_'.join(key)}.{name}",
+                    "dtype": array.dtype.name,
+                    "length": array.shape[0],
+                    "bytes": array.nbytes,
+                    "mapped": False,
+                })
+        report = pd.DataFrame(rows)
+        total = pd.DataFrame([{
+            "component": "total",
+            "dtype": "",
+            "length": pd.NA,
+            "bytes": report.bytes.sum(),
+            "mapped": False,
+        }])
+        report = pd.concat([report, total], ignore_index=True)
+        # nullable integers keep lengths exact next to the empty total
+        report["length"] = report["length"].astype("Int64")
+        return report
+
     def regularize_data(self, arr):
         """Makes each element in array equal size"""
         longest = np.max(np.array([a.shape[0] for a in arr]))
@@ -191,151 +1676,940 @@ class mzXML:
             new_elements.append(zeros)
         return np.array(new_elements)
 
-    def ms1_search(self, val_list, num_dec=2):
+    def ms1_search(self, val_list, tolerance=10, combine=True, rt_range=None):
         """
-        Function to return plot, xs, and ys of multiple masses in
+        Function to return xs and ys of multiple masses in
         pseudo-EIC data.
+
+        Works on the scan store with ppm windows (see ms1_extract_batch),
+        so nothing is re-read from the file and matches do not depend on
+        rounding.
+
+        :arg val_list:  (array-like)    m/z values to search
+        :arg tolerance: (float, array-like) ppm tolerance
+        :arg combine:   (bool)  when True, return the max of all traces,
+                                otherwise one trace per mass
+        :arg rt_range:  (tuple) <optional>  (low, high) retention time
+
+        returns retention times (np.array), intensities (np.array)
         """
-        if self.ms1_data is None:
-            data = self.data
-        else:  # ms1 data has already been created
-            data = self.ms1_data
-        
-        xs, ys = [], []
-        for _, scan in enumerate(data):
-            if scan["msLevel"] == 1:
-                xs.append(scan["retentionTime"])
-                precs = np.round(scan["m/z array"], num_dec)
-                prec_int = scan["intensity array"]
-                pull_int = prec_int[np.isin(precs, val_list)]
-                if pull_int.size == 0:
-                    ys.append(0)
-                else:
-                    ys.append(np.max(pull_int))
-        return np.array(xs), np.array(ys)
+        xs, ys = self.ms1_extract_batch(val_list, tolerance=tolerance, rt_range=rt_range)
+        if not combine:
+            return xs, ys
+        if ys.shape[0] == 0:
+            return xs, np.zeros(xs.shape[0])
+        return xs, ys.max(axis=0)
 
-    def ms1_extract(self, search_mass, tolerance=10):
+    def ms1_extract(self, search_mass, tolerance=10, rt_range=None):
         """
         Function to return plot, xs, and ys of single mass in
         pseudo-EIC data.
+
+        :arg rt_range:  (tuple) <optional>  (low, high) retention time; only
+                                            the MS1 scans inside it are read
         """
-        xs, ys = [], []
-        low, high = mass_tolerance(search_mass, tolerance)
-        for _, scan in enumerate(self.ms1_data):
-            xs.append(scan[0])
-            precs = scan[1]
-            ids = np.where(np.logical_and(precs >= low, precs <= high))
-            if len(ids[0]) > 0:
-                ys.append(np.max(scan[2][ids]))
-            else:
-                ys.append(0)
-        return np.array(xs), np.array(ys)
+        xs, ys = self.ms1_extract_batch([search_mass], tolerance=tolerance, rt_range=rt_range)
+        return xs, ys[0]
+
+    def ms1_extract_batch(self, search_masses, tolerance=10, rt_windows=None, rt_range=None):
+        """
+        Extract pseudo-EICs of many masses in a single pass over the MS1 scans.
+
+        Each scan is searched with np.searchsorted for the low/high edge of
+        every target window, so the cost per scan grows with log(peaks) rather
+        than with a mask over the whole m/z array.
+
+        :arg search_masses: (array-like)    target m/z values
+        :arg tolerance:     (float, array-like) ppm tolerance, one for all
+                                            targets or one per target
+        :arg rt_windows:    (array-like) <optional> Nx2 (low, high) retention
+                                            times per target; scans outside a
+                                            target's window are left at 0
+        :arg rt_range:      (tuple) <optional>  (low, high) retention time of
+                                            the returned scans; scans outside
+                                            it are never read
+
+        returns retention times (np.array), intensities (np.array,
+        targets x scans) holding the most intense peak in each window
+        """
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.ms1_extract_batch(
+                search_masses, tolerance=tolerance, rt_windows=rt_windows, rt_range=rt_range
+            )
+        store = self.store
+        positions = self.rt_index(1).window(rt_range)
+        rts = np.asarray(store.rt[positions])
+
+        targets = np.asarray(search_masses, dtype=np.float64)
+        tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.float64), targets.shape)
+        lows = targets - targets * tolerance / 1e6
+        highs = targets + targets * tolerance / 1e6
+        if rt_windows is not None:
+            rt_windows = np.asarray(rt_windows, dtype=np.float64).reshape(-1, 2)
 
-    def ms2_search(self, search_val, kind="prof", frequency=False):
+        ys = np.zeros((targets.shape[0], positions.shape[0]))
+        active = np.arange(targets.shape[0])
+        for j, position in enumerate(positions):
+            if rt_windows is not None:
+                active = np.flatnonzero(
+                    np.logical_and(rt_windows[:, 0] <= rts[j], rt_windows[:, 1] >= rts[j])
+                )
+                if active.shape[0] == 0:
+                    continue
+            start = store.offsets[position]
+            precs = store.mz[start:store.offsets[position + 1]]
+            lo = np.searchsorted(precs, lows[active], side="left")
+            hi = np.searchsorted(precs, highs[active], side="right")
+            ys[active, j] = _range_reduce(np.maximum, store.intensity, lo + start, hi + start)
+        return rts, ys
+
+    def fragment_index(self, kind="prof"):
+        """
+        FragmentIndex of the MS2 peaks, built once per run and kind.
+
+        :arg kind:  (str)   "prof" indexes every peak, "cent" only the local
+                            maxima of each scan (see centroid_store)
+        """
+        key = ("fragments", kind)
+        if key not in self._indexes:
+            store = self.store
+            if kind == "cent":
+                store = centroid_store(store, ms_level=2, method="apex", keep_others=False)
+            self._indexes[key] = FragmentIndex(store)
+        return self._indexes[key]
+
+    def ms2_search(self, search_val, kind="prof", frequency=False, tolerance=20, rt_range=None):
         """
         Function to return pseudo-EIC of ms2 ion of interest.
+
+        :arg search_val:    (float) fragment m/z
+        :arg kind:          (str)   "prof" or "cent", see fragment_index
+        :arg frequency:     (bool)  also return the number of MS2 scans
+        :arg tolerance:     (float) ppm tolerance around search_val
+        :arg rt_range:      (tuple) <optional>  (low, high) retention time
+
+        returns retention times of all scans, intensities (0 for MS1 scans)
         """
-        num_dig = len(str(search_val).split(".")[-1])
-        xs, ys = np.zeros(len(self.data)), np.zeros(len(self.data))
-        count = 0
-        # xs, ys = [], []
-        for i, scan in enumerate(self.data):
-            rt = scan["retentionTime"]
-            xs[i] = rt
-            if scan["msLevel"] == 2:
-                count += 1
-                if kind == "prof":
-                    try:
-                        frags = np.round(scan["m/z array"], num_dig)
-                        frag_int = scan["intensity array"]
-                        if len(frags) > 1:
-                            idx = np.where(frags == search_val)
-                            if idx[0]:
-                                ys[i] = frag_int[idx[0]]
-                    except Exception as excp:
-                        raise ValueError(
-                            'Possible profile data in file. Call function again with "kind=cent" argument.'
-                        ) from excp
-
-                if kind == "cent":
-                    frags = np.round(scan["m/z array"], num_dig)
-                    frag_int = scan["intensity array"]
-                    idx = argrelextrema(frag_int, np.greater)
-                    frags = frags[idx]
-                    frag_int = frag_int[idx]
-                    if len(frags) > 1:
-                        idx = np.where(frags == search_val)
-                        if idx[0]:
-                            ys[i] = frag_int[idx[0]]
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.ms2_search(
+                search_val, kind=kind, frequency=frequency, tolerance=tolerance,
+                rt_range=rt_range,
+            )
+        store = self.store
+        index = self.fragment_index(kind)
+        positions = self.rt_index().window(rt_range)
+        ms2 = self.rt_index(2).window(rt_range)
+
+        xs = np.asarray(store.rt[positions])
+        ys = np.zeros(positions.shape[0])
+        ys[np.searchsorted(positions, ms2)] = index.traces(
+            [search_val], tolerance=tolerance, positions=ms2
+        )[0]
         if frequency:
-            return np.array(xs), np.array(ys), count
-        return np.array(xs), np.array(ys)
-    
-    def prm_transition_extract(self, prec_mass, expected_transitions, tolerance=20):
-        """Take in precursor mass and the transitions desired, output trace"""
+            return xs, ys, ms2.shape[0]
+        return xs, ys
+
+    def ms2_search_batch(self, search_masses, kind="prof", tolerance=20, rt_range=None):
+        """
+        Pseudo-EICs of many fragment ions, e.g. the oxonium ions in
+        ms_handler.modifications, from the run's FragmentIndex.
+
+        :arg search_masses: (array-like, dict)  fragment m/z values; dict
+                                                values are used when a dict
+                                                of {name: m/z} is passed
+        :arg kind:          (str)   "prof" or "cent", see fragment_index
+        :arg tolerance:     (float, array-like) ppm tolerance
+        :arg rt_range:      (tuple) <optional>  (low, high) retention time
+
+        returns retention times of the MS2 scans, intensities (np.array,
+        ions x MS2 scans)
+        """
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.ms2_search_batch(
+                search_masses, kind=kind, tolerance=tolerance, rt_range=rt_range
+            )
+        if isinstance(search_masses, dict):
+            search_masses = list(search_masses.values())
+        index = self.fragment_index(kind)
+        positions = self.rt_index(2).window(rt_range)
+        ys = index.traces(search_masses, tolerance=tolerance, positions=positions)
+        return np.asarray(self.store.rt[positions]), ys
+
+    def prm_transition_extract(self, prec_mass, expected_transitions, tolerance=20, rt_range=None):
+        """
+        Take in precursor mass and the transitions desired, output trace
+        of every transition. See prm_extract for whole assays.
 
-        time, precursor_mass = self.ms2_data[:, 0], self.ms2_data[:, 1]
-        frag_masses = self.ms2_data[:, 3]
-        frag_int = self.ms2_data[:, 4]
+        :arg rt_range:  (tuple) <optional>  (low, high) retention time
 
+        returns pd.DataFrame with precursor, time, transition_mz and
+        transition_intensity columns
+        """
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.prm_transition_extract(
+                prec_mass, expected_transitions, tolerance=tolerance, rt_range=rt_range
+            )
         prec_low, prec_high = mass_tolerance(prec_mass, ppm=tolerance)
-        prec_index = np.where(np.logical_and(precursor_mass>=prec_low, precursor_mass<=prec_high))
-        
-        time_points = time[prec_index]
-        if len(prec_index[0]) == 0:
+        prec_mz = self.store.prec_mz
+        if not np.any(np.logical_and(prec_mz >= prec_low, prec_mz <= prec_high)):
             raise Exception(f"No Precursor mass {prec_mass} found in dataset")
-        
-        frag_masses = self.regularize_data(frag_masses[prec_index])
-        frag_int = self.regularize_data(frag_int[prec_index])
 
-        for transition in expected_transitions:
+        assay = pd.DataFrame({
+            "precursor": prec_mass,
+            "transition_mz": np.asarray(expected_transitions, dtype=np.float64),
+        })
+        sub = self.prm_extract(
+            assay, tolerance=tolerance, transition_tolerance=25, rt_range=rt_range
+        )
+        return sub.loc[:, ["precursor", "time", "transition_mz", "transition_intensity"]]
+
+    def prm_extract(self, assay, tolerance=20, transition_tolerance=25, rt_range=None):
+        """
+        Extract the traces of every transition of a PRM/SRM assay.
+
+        MS2 scans are matched to assay precursors through the precursor table
+        and transitions are searched directly in the ragged peak arrays of the
+        matched scans, so no scan is padded or copied.
 
-            data_points = np.zeros(shape=time_points.shape)
+        :arg assay:                 (pd.DataFrame)  one row per transition with
+                                                    "precursor" and "transition_mz"
+                                                    columns; other columns (e.g.
+                                                    peptide names) are carried over
+        :arg tolerance:             (float) ppm tolerance of precursor matching
+        :arg transition_tolerance:  (float) ppm tolerance of transition matching
+        :arg rt_range:              (tuple) <optional>  (low, high) retention
+                                                    time; matched scans outside
+                                                    it are not searched
 
-            trans_low, trans_high = mass_tolerance(transition, ppm=25)
+        returns long-form pd.DataFrame with the assay columns plus scan, time
+        and transition_intensity; one row per transition and matched scan
+        """
+        window = self._lazy_window(rt_range)
+        if window is not None:
+            return window.prm_extract(
+                assay, tolerance=tolerance, transition_tolerance=transition_tolerance,
+                rt_range=rt_range,
+            )
+        store = self.store
+        assay = assay.reset_index(drop=True)
+        precursors = assay["precursor"].to_numpy(dtype=np.float64)
+        transitions = assay["transition_mz"].to_numpy(dtype=np.float64)
+        unique_prec, prec_group = np.unique(precursors, return_inverse=True)
 
-            frag_idx = np.where(np.logical_and(frag_masses>=trans_low, frag_masses<=trans_high))
-            data_points[frag_idx[0]] = frag_int[frag_idx]
+        # match assay precursors against the sorted precursor table
+        order = np.argsort(store.prec_mz, kind="stable")
+        sorted_prec = np.asarray(store.prec_mz)[order]
+        lows = unique_prec - unique_prec * tolerance / 1e6
+        highs = unique_prec + unique_prec * tolerance / 1e6
+        hit_index, hit_group = _range_index(
+            np.searchsorted(sorted_prec, lows, side="left"),
+            np.searchsorted(sorted_prec, highs, side="right"),
+        )
+        hit_scan = np.asarray(store.prec_scan)[order[hit_index]]
+        # multiplexed scans may match the same precursor twice
+        pairs = np.unique(np.stack([hit_group, hit_scan], axis=1), axis=0)
+        hit_group, hit_scan = pairs[:, 0], pairs[:, 1]
+        if rt_range is not None:
+            hit_rt = np.asarray(store.rt[hit_scan])
+            inside = np.logical_and(hit_rt >= rt_range[0], hit_rt <= rt_range[1])
+            hit_group, hit_scan = hit_group[inside], hit_scan[inside]
 
-            sub = pd.DataFrame({
-                "precursor":prec_mass,
-                "time":time_points,
-                "transition_mz": transition, 
-                "transition_intensity": data_points
-            })
+        # cross every matched scan with the transitions of its precursor
+        rows_by_group = np.argsort(prec_group, kind="stable")
+        group_counts = np.bincount(prec_group, minlength=unique_prec.shape[0])
+        group_starts = np.cumsum(group_counts) - group_counts
+        row_index, hit = _range_index(
+            group_starts[hit_group], group_starts[hit_group] + group_counts[hit_group]
+        )
+        q_row = rows_by_group[row_index]
+        q_scan = hit_scan[hit]
+
+        # transition windows inside each scan
+        targets = transitions[q_row]
+        starts = np.asarray(store.offsets[q_scan])
+        stops = np.asarray(store.offsets[q_scan + 1])
+        lo = _ragged_searchsorted(
+            store.mz, starts, stops, targets - targets * transition_tolerance / 1e6, side="left"
+        )
+        hi = _ragged_searchsorted(
+            store.mz, starts, stops, targets + targets * transition_tolerance / 1e6, side="right"
+        )
+
+        result = assay.iloc[q_row].reset_index(drop=True)
+        result["scan"] = np.asarray(store.scan_num[q_scan])
+        result["time"] = np.asarray(store.rt[q_scan])
+        result["transition_intensity"] = _range_reduce(np.maximum, store.intensity, lo, hi)
+        result["_row"] = q_row
+        result = result.sort_values(["_row", "time"], kind="stable")
+        return result.drop(columns="_row").reset_index(drop=True)
+
+
+class mzML(mzXML):
+    """
+    Class constructed for (indexed) mzML data processing.
+
+    Offers the mzXML methods on mzML files. Spectra are addressed by scan
+    number or by their native ID; native IDs are resolved through the
+    offset index of the file instead of a scan by scan search.
+    """
 
-            return sub
+    def __repr__(self):
+        return f"mzML object constructed from {self.path_to_file}"
+
+    @property
+    def data(self):
+        """Fresh pyteomics reader over the source file."""
+        return mzml.read(self.path_to_file, use_index=True)
+
+    def _indexed_reader(self):
+        """pyteomics reader with random access by native ID."""
+        return mzml.MzML(self.path_to_file, use_index=True, decode_binary=False)
+
+    def _ordered_ids(self):
+        """Native IDs of the file in the order they are stored in the ScanStore."""
+        return list(self._reader()._offset_index["spectrum"])
 
+    def _native_positions(self):
+        """Map of native ID to store position, built once from the offset index."""
+        if "native_ids" not in self._indexes:
+            self._indexes["native_ids"] = {
+                native_id: position for position, native_id in enumerate(self._ordered_ids())
+            }
+        return self._indexes["native_ids"]
+
+    def _reader_ids(self):
+        """Map of scan number to native ID."""
+        if "reader_ids" not in self._indexes:
+            reader_ids = {}
+            for position, native_id in enumerate(self._ordered_ids()):
+                match = re.search(r"scan=(\d+)", native_id)
+                reader_ids[int(match.group(1)) if match else position + 1] = native_id
+            self._indexes["reader_ids"] = reader_ids
+        return self._indexes["reader_ids"]
+
+    def _iter_raw_scans(self):
+        """
+        <generator>
+
+        Yields every spectrum of the file with its peak arrays left encoded.
+        """
+        reader = mzml.read(self.path_to_file, decode_binary=False)
+        for spectrum in reader:
+            yield self._parse_scan(spectrum)
+
+    def _chunk_scans(self, data):
+        """
+        <generator>
+
+        Spectra of `data`: the head of the file followed by consecutive
+        spectra cut out of it, see mzXML._read_scans. The head holds the
+        referenceable param groups the spectra may point to; the controlled
+        vocabulary is shared with the indexed reader instead of loaded again.
+        """
+        reader = mzml.MzML(
+            io.BytesIO(data), use_index=False, decode_binary=False, cv=self._reader().cv
+        )
+        for spectrum in reader:
+            yield self._parse_scan(spectrum)
+
+    def _parse_scan(self, spectrum):
+        """
+        Normalize one pyteomics mzML spectrum into a Scan. Retention times
+        are converted to minutes to match mzXML.
+        """
+        scan_info = spectrum["scanList"]["scan"][0]
+        rt = scan_info["scan start time"]
+        if getattr(rt, "unit_info", "minute") == "second":
+            rt = rt / 60
+
+        precursors = []
+        for precursor in spectrum.get("precursorList", {}).get("precursor", []):
+            ion = precursor["selectedIonList"]["selectedIon"][0]
+            window = precursor.get("isolationWindow", {})
+            target = window.get("isolation window target m/z", ion["selected ion m/z"])
+            precursors.append(
+                (
+                    ion["selected ion m/z"],
+                    ion.get("charge state", 0),
+                    ion.get("peak intensity", 0.0),
+                    target - window.get("isolation window lower offset", np.nan),
+                    target + window.get("isolation window upper offset", np.nan),
+                )
+            )
+
+        match = re.search(r"scan=(\d+)", spectrum["id"])
+        scan_num = int(match.group(1)) if match else spectrum["index"] + 1
+        return Scan(
+            scan_num,
+            float(rt),
+            spectrum["ms level"],
+            spectrum["m/z array"],
+            spectrum["intensity array"],
+            precursors,
+        )
+
+    def _iter_headers(self):
+        """
+        <generator>
+
+        Reads spectrum attributes and cvParams with lxml.iterparse. Binary
+        data arrays are dropped as soon as they are parsed and never decoded.
+        Retention times are converted to minutes.
+
+        yields dict of header values, see HEADER_COLUMNS
+        """
+        row = None
+        in_precursor = False
+        context = etree.iterparse(
+            self.path_to_file,
+            events=("start", "end"),
+            tag=("{*}spectrum", "{*}cvParam", "{*}precursor", "{*}binaryDataArrayList"),
+            huge_tree=True,
+        )
+        for event, elem in context:
+            tag = elem.tag.rpartition("}")[2]
+            if tag == "cvParam":
+                if event == "start" and row is not None:
+                    _mzml_header_param(row, elem.attrib, in_precursor)
+            elif tag == "spectrum":
+                if event == "start":
+                    attrs = elem.attrib
+                    match = re.search(r"scan=(\d+)", attrs["id"])
+                    row = {
+                        "scan": int(match.group(1)) if match else int(attrs["index"]) + 1,
+                        "peaks_count": int(attrs.get("defaultArrayLength", 0)),
+                        "n_precursors": 0,
+                    }
+                    continue
+                if "isolation_lower" in row or "isolation_upper" in row:
+                    row["isolation_width"] = (
+                        row.pop("isolation_lower", 0.0) + row.pop("isolation_upper", 0.0)
+                    )
+                yield row
+                row = None
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif tag == "precursor":
+                in_precursor = event == "start"
+                if in_precursor:
+                    row["n_precursors"] += 1
+                    ref = re.search(r"scan=(\d+)", elem.get("spectrumRef", ""))
+                    if ref and row["n_precursors"] == 1:
+                        row["precursor_scan"] = int(ref.group(1))
+            elif event == "end":
+                elem.clear()
+
+    def get_scan(self, scan_num):
+        """
+        Function that returns the m/z and intensity arrays from given scan.
+
+        :param scan_num: scan index number (int), scan number (numeric str)
+                         or native ID (str)
+
+        :returns: m/z array, intensity array (writable copies)
+        """
+        if isinstance(scan_num, str) and not scan_num.isdigit():
+            try:
+                position = self._native_positions()[scan_num]
+            except KeyError as excp:
+                raise KeyError(f"Spectrum {scan_num} not found in {self.path_to_file}") from excp
+            mz, intensity = self.store.peaks(position)
+            return np.array(mz), np.array(intensity)
+        return super().get_scan(scan_num)
+
+    def get_spectrum(self, native_id):
+        """
+        Read a single spectrum straight from the file through the offset
+        index, without building the store.
+
+        returns Scan
+        """
+        return self._parse_scan(self._indexed_reader().get_by_id(native_id))
 
 
 ###############################################################################
 
 
-def fragments(peptide, types=("b", "y"), max_charge=1):
+def _decode_chunk(run_cls, path, ids, mz_dtype, intensity_dtype):
     """
-    Function that returns theoretical fragments of peptide.
-    Modeled from : https://pyteomics.readthedocs.io/en/latest/examples/example_msms.html
+    Process pool target of mzXML._parallel_store. Decodes the scans `ids`
+    of `path` into a ScanStore.
 
-    :param peptide: (str) peptide sequence
-    :param types: (tuple) types of fragments desired
-    :param max_charge: (int) maximum charge state of fragment ions
+    returns ScanStore, IngestStats report of the chunk
     """
-    d = {}
-    for ion_type in types:
-        d[ion_type] = []
-        for i in range(1, len(peptide)):
-            for charge in range(1, max_charge + 1):
-                if ion_type[0] in "abc":
-                    if i == 0:
-                        continue
-                    m = mass.fast_mass(peptide[:i], ion_type=ion_type, charge=charge)
-                else:
-                    m = mass.fast_mass(peptide[i:], ion_type=ion_type, charge=charge)
-                d[ion_type].append(m)
-    return d
+    run = run_cls.from_store(None, path)
+    reader = run._indexed_reader()
+    scans = (run._parse_scan(reader.get_by_id(scan_id)) for scan_id in ids)
+    stats = IngestStats(every=np.inf)
+    store = ScanStore.from_scans(
+        scans, mz_dtype=mz_dtype, intensity_dtype=intensity_dtype, stats=stats
+    )
+    return store, stats.report()
+
+
+def _duration_minutes(duration):
+    """Convert an xs:duration such as "PT12.5S" to minutes, nan if missing."""
+    if not duration:
+        return np.nan
+    match = re.fullmatch(
+        r"-?P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?", duration.strip()
+    )
+    if match is None:
+        raise ValueError(f"Unknown retention time {duration}")
+    days, hours, minutes, seconds = (float(value or 0) for value in match.groups())
+    return days * 1440 + hours * 60 + minutes + seconds / 60
+
+
+def _mzml_header_param(row, attrs, in_precursor):
+    """Store the header value of one mzML cvParam in `row`."""
+    accession = attrs.get("accession")
+    if in_precursor:
+        if row["n_precursors"] > 1:
+            return
+        if accession in MZML_ACTIVATIONS:
+            row["activation"] = MZML_ACTIVATIONS[accession]
+            return
+    name = MZML_HEADER_ACCESSIONS.get(accession)
+    if name is None:
+        if accession == "MS:1000127":
+            row["centroided"] = True
+        elif accession == "MS:1000130":
+            row["polarity"] = "+"
+        elif accession == "MS:1000129":
+            row["polarity"] = "-"
+        return
+    if name.startswith(("precursor", "isolation")) != in_precursor:
+        return
+    value = float(attrs["value"])
+    if name == "rt" and attrs.get("unitName") == "second":
+        value = value / 60
+    row[name] = value
+
+
+def _header_table(rows):
+    """
+    Typed header table from an iterable of header dicts; missing values
+    are filled with the defaults of HEADER_COLUMNS.
+    """
+    columns = {name: [] for name in HEADER_COLUMNS}
+    for row in rows:
+        for name, (_, default) in HEADER_COLUMNS.items():
+            columns[name].append(row.get(name, default))
+    table = pd.DataFrame({
+        name: np.array(values, dtype=HEADER_COLUMNS[name][0])
+        for name, values in columns.items()
+    })
+    return table.sort_values("scan", kind="stable").reset_index(drop=True)
+
+
+def _filter_scans(scans, ms_level=None, rt_range=None, precursor_range=None):
+    """
+    <generator>
+
+    Filter a time-ordered stream of Scan objects on header values only.
+    Iteration stops at the first scan past the end of `rt_range`.
+    """
+    for scan in scans:
+        if rt_range is not None:
+            if scan.rt < rt_range[0]:
+                continue
+            if scan.rt > rt_range[1]:
+                return
+        if ms_level is not None and scan.ms_level != ms_level:
+            continue
+        if precursor_range is not None:
+            low, high = precursor_range
+            if not any(low <= p[0] <= high for p in scan.precursors):
+                continue
+        yield scan
+
+
+def _concat(arrays, dtype):
+    """
+    Concatenate list of arrays into one native-endian array of `dtype`;
+    None keeps the common dtype of the arrays.
+    """
+    if not arrays:
+        return np.zeros(0, dtype=np.float64 if dtype is None else dtype)
+    joined = np.concatenate(arrays)
+    if dtype is None:
+        dtype = joined.dtype.newbyteorder("=")
+    return joined.astype(dtype, copy=False)
+
+
+def _ragged_take(offsets, mz, intensity, take):
+    """
+    Pick (and repeat) scans of a ragged result by their index `take`.
+
+    returns offsets, m/z and intensity of the picked scans
+    """
+    lengths = np.diff(offsets)[take]
+    index, _ = _range_index(offsets[take], offsets[take] + lengths)
+    new_offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    return new_offsets, mz[index], intensity[index]
+
+
+def _range_index(starts, stops):
+    """
+    Flatten several [start, stop) ranges of a flat array.
+
+    returns flat indices (np.array) and, for each of them, the number of the
+    range it belongs to (np.array)
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(stops, dtype=np.int64) - starts
+    segments = np.repeat(np.arange(starts.shape[0]), lengths)
+    # position of every index inside its own range
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[segments] + within, segments
+
+
+def _ragged_index(offsets, positions):
+    """
+    Gather the peaks of several scans of a ragged store.
+
+    :arg offsets:   (np.array)  store offsets, len(n_scans + 1)
+    :arg positions: (np.array)  scan positions to gather
+
+    returns flat peak indices (np.array) and, for each of them, the index of
+    its scan within `positions` (np.array)
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    return _range_index(offsets[positions], offsets[positions + 1])
+
+
+def _ragged_searchsorted(values, starts, stops, targets, side="left"):
+    """
+    np.searchsorted of every target inside its own sorted slice
+    values[start:stop], run as one vectorized bisection over all targets.
+
+    returns flat insertion indices (np.array), between start and stop
+    """
+    lo = np.array(starts, dtype=np.int64)
+    hi = np.array(stops, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.float64)
+    while True:
+        open_ = lo < hi
+        if not open_.any():
+            return lo
+        mid = (lo + hi) // 2
+        mid_vals = np.asarray(values[np.where(open_, mid, 0)])
+        if side == "left":
+            right = mid_vals < targets
+        else:
+            right = mid_vals <= targets
+        lo = np.where(open_ & right, mid + 1, lo)
+        hi = np.where(open_ & ~right, mid, hi)
+
+
+def _range_reduce(ufunc, values, starts, stops, empty=0):
+    """
+    Reduce `values` over several [start, stop) ranges with `ufunc`
+    (e.g. np.maximum). Empty ranges get `empty`.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    out = np.full(starts.shape[0], empty, dtype=np.float64)
+    filled = stops > starts
+    if filled.any():
+        index, _ = _range_index(starts[filled], stops[filled])
+        lengths = stops[filled] - starts[filled]
+        bounds = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        out[filled] = ufunc.reduceat(values[index], bounds)
+    return out
+
+
+def centroid_store(store, ms_level=None, method="parabolic", noise=0.0, relative=0.0,
+                   keep_others=True, workers=1):
+    """
+    Centroid the profile scans of a run in batch.
+
+    Local maxima of every scan are found on the flat peak arrays at once;
+    their position and height are refined from the two neighbouring samples.
+
+    :arg store:         (ScanStore) run holding profile data
+    :arg ms_level:      (int) <optional>    centroid only scans of this level
+    :arg method:        (str)   "parabolic" or "gaussian" apex interpolation
+                                (a parabola through the intensities or their
+                                log), or "apex" to keep the raw maximum sample
+    :arg noise:         (float) minimum centroid intensity
+    :arg relative:      (float) minimum centroid intensity as a fraction of
+                                the base peak of its scan
+    :arg keep_others:   (bool)  keep peaks of scans that are not centroided,
+                                otherwise those scans are left empty
+    :arg workers:       (int)   number of processes sharing the scans
+
+    returns ScanStore with the same scans and precursors
+    """
+    if method not in ("parabolic", "gaussian", "apex"):
+        raise ValueError(f"Unknown centroiding method {method}")
+
+    selected = np.ones(store.n_scans, dtype=bool)
+    if ms_level is not None:
+        selected = np.asarray(store.ms_level) == ms_level
+    positions = np.flatnonzero(selected)
+
+    index, _ = _ragged_index(store.offsets, positions)
+    lengths = np.asarray(store.offsets[positions + 1] - store.offsets[positions])
+    offsets = np.zeros(positions.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    mz = np.asarray(store.mz[index])
+    intensity = np.asarray(store.intensity[index])
+
+    if workers > 1:
+        bounds = np.linspace(0, positions.shape[0], workers * 4 + 1).astype(int)
+        bounds = np.unique(bounds)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(
+                _centroid_segments,
+                [mz[offsets[lo]:offsets[hi]] for lo, hi in zip(bounds[:-1], bounds[1:])],
+                [intensity[offsets[lo]:offsets[hi]] for lo, hi in zip(bounds[:-1], bounds[1:])],
+                [offsets[lo:hi + 1] - offsets[lo] for lo, hi in zip(bounds[:-1], bounds[1:])],
+                [method] * (bounds.shape[0] - 1),
+                [noise] * (bounds.shape[0] - 1),
+                [relative] * (bounds.shape[0] - 1),
+            ))
+        c_mz = np.concatenate([p[0] for p in parts])
+        c_int = np.concatenate([p[1] for p in parts])
+        c_len = np.concatenate([p[2] for p in parts])
+    else:
+        c_mz, c_int, c_len = _centroid_segments(mz, intensity, offsets, method, noise, relative)
+
+    # lay centroided and untouched scans out in scan order
+    new_lengths = np.zeros(store.n_scans, dtype=np.int64)
+    new_lengths[positions] = c_len
+    others = np.flatnonzero(~selected) if keep_others else np.zeros(0, dtype=np.int64)
+    new_lengths[others] = np.asarray(store.offsets[others + 1] - store.offsets[others])
+    new_offsets = np.zeros(store.n_scans + 1, dtype=np.int64)
+    np.cumsum(new_lengths, out=new_offsets[1:])
+
+    new_mz = np.zeros(new_offsets[-1], dtype=store.mz.dtype)
+    new_int = np.zeros(new_offsets[-1], dtype=store.intensity.dtype)
+    dest, _ = _ragged_index(new_offsets, positions)
+    new_mz[dest], new_int[dest] = c_mz, c_int
+    if others.shape[0]:
+        dest, _ = _ragged_index(new_offsets, others)
+        source, _ = _ragged_index(store.offsets, others)
+        new_mz[dest], new_int[dest] = store.mz[source], store.intensity[source]
+
+    arrays = {
+        name: getattr(store, name)
+        for name in ScanStore.columns()
+        if name not in ScanStore.summary_columns
+    }
+    arrays.update(offsets=new_offsets, mz=new_mz, intensity=new_int)
+    return ScanStore(meta=dict(store.meta, centroided=method), **arrays)
+
+
+def isolation_purity(store, isolation_width=None, tolerance=10, n_isotopes=3):
+    """
+    Fraction of the MS1 signal inside each isolation window that belongs to
+    the isotope envelope of the selected precursor; 1 - purity is the
+    precursor interference of a chimeric spectrum.
+
+    Every MS2 precursor is linked to the last MS1 scan before it in scan
+    order. Window and isotope peaks of all precursors are then found at
+    once with binary searches in the ragged peak arrays of the parent
+    scans, so no scan is visited in Python.
+
+    :arg store:             (ScanStore) run with MS1 and MS2 scans
+    :arg isolation_width:   (float) <optional>  full width (m/z) of windows
+                                                centered on the precursor; used
+                                                for every precursor when given,
+                                                otherwise only where the file
+                                                records no isolation window
+    :arg tolerance:         (float) ppm tolerance of isotope peaks
+    :arg n_isotopes:        (int)   isotope peaks of the envelope, starting
+                                    at the precursor m/z; precursors of
+                                    unknown charge count only their own peak
+
+    returns dict of np.arrays, one entry per precursor: parent (store
+    position of the MS1 scan, -1 when there is none), window_low,
+    window_high, envelope_intensity, window_intensity and purity (nan
+    without parent or signal in the window)
+    """
+    prec_mz = np.asarray(store.prec_mz, dtype=np.float64)
+    charge = np.asarray(store.prec_charge, dtype=np.int64)
+    low = np.asarray(store.prec_lower, dtype=np.float64).copy()
+    high = np.asarray(store.prec_upper, dtype=np.float64).copy()
+    missing = np.isnan(low) | np.isnan(high)
+    if isolation_width is not None:
+        missing[:] = True
+    width = np.nan if isolation_width is None else isolation_width
+    low[missing] = prec_mz[missing] - width / 2
+    high[missing] = prec_mz[missing] + width / 2
+
+    # parent MS1: the last MS1 scan before each MS2
+    ms1 = np.flatnonzero(np.asarray(store.ms_level) == 1)
+    before = np.searchsorted(ms1, np.asarray(store.prec_scan), side="left") - 1
+    parent = np.where(before >= 0, ms1[np.maximum(before, 0)], -1)
+    has_parent = (parent >= 0) & ~np.isnan(low)
+
+    n_prec = prec_mz.shape[0]
+    window_intensity = np.zeros(n_prec)
+    envelope_intensity = np.zeros(n_prec)
+    linked = np.flatnonzero(has_parent)
+    if linked.shape[0]:
+        starts = np.asarray(store.offsets[parent[linked]])
+        stops = np.asarray(store.offsets[parent[linked] + 1])
+        lo = _ragged_searchsorted(store.mz, starts, stops, low[linked], side="left")
+        hi = _ragged_searchsorted(store.mz, starts, stops, high[linked], side="right")
+        window_intensity[linked] = _range_reduce(np.add, store.intensity, lo, hi)
+
+        # isotope k of precursor i at m/z + k * 1.00335 / z, clipped to its window
+        isotopes = np.arange(n_isotopes)
+        z = np.maximum(charge[linked], 1)
+        targets = prec_mz[linked, None] + isotopes[None, :] * 1.0033548 / z[:, None]
+        valid = np.broadcast_to(isotopes[None, :] == 0, targets.shape) | (charge[linked, None] > 0)
+        iso_low = np.maximum(targets - targets * tolerance / 1e6, low[linked, None])
+        iso_high = np.minimum(targets + targets * tolerance / 1e6, high[linked, None])
+        valid = valid & (iso_high >= iso_low)
+
+        rows = np.repeat(np.arange(linked.shape[0]), n_isotopes)[valid.ravel()]
+        iso_lo = _ragged_searchsorted(
+            store.mz, starts[rows], stops[rows], iso_low[valid], side="left"
+        )
+        iso_hi = _ragged_searchsorted(
+            store.mz, starts[rows], stops[rows], iso_high[valid], side="right"
+        )
+        sums = _range_reduce(np.add, store.intensity, iso_lo, iso_hi)
+        envelope_intensity[linked] = np.bincount(rows, weights=sums, minlength=linked.shape[0])
+
+    purity = np.full(n_prec, np.nan)
+    signal = has_parent & (window_intensity > 0)
+    purity[signal] = envelope_intensity[signal] / window_intensity[signal]
+    return {
+        "parent": parent,
+        "window_low": low,
+        "window_high": high,
+        "envelope_intensity": envelope_intensity,
+        "window_intensity": window_intensity,
+        "purity": purity,
+    }
+
+
+def _centroid_segments(mz, intensity, offsets, method="parabolic", noise=0.0, relative=0.0):
+    """
+    Centroid ragged profile scans held in flat arrays.
+
+    A local maximum is a sample strictly more intense than both neighbours
+    of the same scan, as argrelextrema(ys, np.greater) finds per scan.
+
+    returns centroid m/z (np.array), intensity (np.array) and number of
+    centroids per scan (np.array)
+    """
+    n_segments = offsets.shape[0] - 1
+    lengths = np.diff(offsets)
+    segments = np.repeat(np.arange(n_segments), lengths)
+
+    is_max = np.zeros(mz.shape[0], dtype=bool)
+    if mz.shape[0] > 2:
+        interior = (segments[1:-1] == segments[:-2]) & (segments[1:-1] == segments[2:])
+        rising = intensity[1:-1] > intensity[:-2]
+        falling = intensity[1:-1] > intensity[2:]
+        is_max[1:-1] = interior & rising & falling
+    apex = np.flatnonzero(is_max)
+
+    x0, x1, x2 = mz[apex - 1], mz[apex], mz[apex + 1]
+    y0, y1, y2 = (intensity[apex - 1].astype(np.float64), intensity[apex].astype(np.float64),
+                  intensity[apex + 1].astype(np.float64))
+    if method == "apex":
+        c_mz, c_int = x1.astype(np.float64), y1
+    elif method == "gaussian":
+        positive = (y0 > 0) & (y2 > 0)
+        c_mz, c_int = _parabola_vertex(x0, x1, x2, y0, y1, y2)
+        g_mz, g_log = _parabola_vertex(
+            x0, x1, x2,
+            np.log(np.where(positive, y0, 1)), np.log(y1), np.log(np.where(positive, y2, 1)),
+        )
+        c_mz = np.where(positive, g_mz, c_mz)
+        c_int = np.where(positive, np.exp(g_log), c_int)
+    else:
+        c_mz, c_int = _parabola_vertex(x0, x1, x2, y0, y1, y2)
+
+    keep = c_int >= noise
+    if relative > 0:
+        base = np.zeros(n_segments)
+        np.maximum.at(base, segments[apex], c_int)
+        keep &= c_int >= relative * base[segments[apex]]
+
+    counts = np.bincount(segments[apex][keep], minlength=n_segments)
+    return c_mz[keep], c_int[keep], counts
+
+
+def _parabola_vertex(x0, x1, x2, y0, y1, y2):
+    """
+    Vertex of the parabolas through (x0, y0), (x1, y1), (x2, y2) where the
+    middle point is a local maximum. Falls back to (x1, y1) where the three
+    points are collinear.
+
+    returns vertex x (np.array), vertex y (np.array)
+    """
+    d0 = np.asarray(x0, dtype=np.float64) - x1
+    d2 = np.asarray(x2, dtype=np.float64) - x1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s0 = (y0 - y1) / d0
+        s2 = (y2 - y1) / d2
+        a = (s0 - s2) / (d0 - d2)
+        b = s0 - a * d0
+        shift = np.clip(-b / (2 * a), d0, d2)
+    curved = a < 0
+    shift = np.where(curved, shift, 0)
+    top = np.where(curved, y1 + b * shift + a * shift ** 2, y1)
+    return x1 + shift, top
+
+
+def _summary_columns(mz, intensity, offsets):
+    """
+    Total ion current, base peak intensity and base peak m/z of every scan
+    of a ragged store, computed with one reduceat per column.
+
+    returns dict of np.arrays
+    """
+    lengths = np.diff(offsets)
+    tic = _segment_reduce(np.add, intensity, offsets)
+    bpi = _segment_reduce(np.maximum, intensity, offsets)
+
+    # first peak of every scan reaching the base peak intensity
+    peak_index = np.arange(intensity.shape[0], dtype=np.float64)
+    is_base = np.asarray(intensity) == np.repeat(bpi, lengths)
+    candidates = np.where(is_base, peak_index, np.inf)
+    base = _segment_reduce(np.minimum, candidates, offsets, empty=-1)
+    bpi_mz = np.zeros(lengths.shape[0])
+    bpi_mz[base >= 0] = np.asarray(mz)[base[base >= 0].astype(np.int64)]
+
+    return {"tic": tic, "bpi": bpi, "bpi_mz": bpi_mz}
+
+
+def _segment_reduce(ufunc, values, offsets, positions=None, empty=0):
+    """
+    Reduce `values` over the scans at `positions` with `ufunc` (e.g. np.maximum),
+    over every scan when `positions` is None. Scans without peaks get `empty`.
+    """
+    if positions is None:
+        # scans tile the flat arrays, so one reduceat over them needs no gather
+        lengths = np.diff(offsets)
+        out = np.full(lengths.shape[0], empty, dtype=np.float64)
+        filled = lengths > 0
+        if filled.any():
+            out[filled] = ufunc.reduceat(np.asarray(values), offsets[:-1][filled])
+        return out
+    positions = np.asarray(positions, dtype=np.int64)
+    return _range_reduce(
+        ufunc, values, offsets[positions], offsets[positions + 1], empty=empty
+    )
+
+
+###############################################################################
 
 
-def prof_to_cent(xs, ys):
+def prof_to_cent(xs, ys, method="apex"):
     """
     Function to turn profile data to centroid.
     Collects relative maximums and uses indexes of those
@@ -343,9 +2617,12 @@ def prof_to_cent(xs, ys):
 
     :param xs: (array) array of x data
     :param ys: (array) array of y data
+    :param method: (str) "apex" keeps the maximum samples, "parabolic" or
+                   "gaussian" interpolate them (see centroid_store)
     """
-    idx = argrelextrema(ys, np.greater)
-    xs, ys = xs[idx], ys[idx]
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    offsets = np.array([0, xs.shape[0]])
+    xs, ys, _ = _centroid_segments(xs, ys, offsets, method=method)
     return xs, ys
 
 
@@ -0,0 +1,268 @@
+################################################################
+# module to run the same my_mzml queries over many runs at once #
+################################################################
+
+import os
+import time
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+
+from my_mzml import mzXML, mzML
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def find_runs(directory=".", exts=(".mzXML", ".mzML")):
+    """
+    Function that searches the defined directory and returns list
+    of all mass spec runs with the specified extensions.
+
+    :param directory: (str) raw string of directory to be searched
+    :param exts: (tuple) extensions of the runs to be returned
+    """
+    all_files = []
+    for root, _, files in os.walk(directory, topdown=True):
+        for name in files:
+            if name.lower().endswith(tuple(ext.lower() for ext in exts)):
+                all_files.append(os.path.join(root, name))
+    return sorted(all_files)
+
+
+def open_run(path, **kwargs):
+    """Open mzXML or mzML object depending on the file extension."""
+    if path.lower().endswith(".mzml"):
+        return mzML(path, **kwargs)
+    return mzXML(path, **kwargs)
+
+
+def _trace_frame(rts, ys, targets):
+    """Long-form frame of a targets x scans intensity matrix."""
+    return pd.DataFrame({
+        "target": np.repeat(np.asarray(targets, dtype="object"), rts.shape[0]),
+        "rt": np.tile(rts, len(targets)),
+        "intensity": ys.ravel(),
+    })
+
+
+def apply_query(run, query):
+    """
+    Apply one query spec to an open run.
+
+    Query specs are dicts with a "kind" key and the arguments of the
+    matching mzXML method:
+        {"kind": "xic", "targets": [...], "tolerance": 10, "rt_windows": None}
+        {"kind": "ms2", "targets": [...] or {name: m/z}, "tolerance": 20,
+         "peaks": "prof" or "cent"}
+        {"kind": "prm", "assay": pd.DataFrame, "tolerance": 20,
+         "transition_tolerance": 25}
+        {"kind": "tic", "ms_level": 1}
+    Targets given as dict {name: m/z} are reported by name. Every kind
+    also accepts an "rt_range": (low, high) key limiting it to a window.
+
+    returns long-form pd.DataFrame
+    """
+    kind = query["kind"]
+    targets = query.get("targets", [])
+    names = list(targets.keys()) if isinstance(targets, dict) else list(targets)
+    masses = list(targets.values()) if isinstance(targets, dict) else list(targets)
+
+    match kind:
+        case "xic":
+            rts, ys = run.ms1_extract_batch(
+                masses,
+                tolerance=query.get("tolerance", 10),
+                rt_windows=query.get("rt_windows"),
+                rt_range=query.get("rt_range"),
+            )
+            return _trace_frame(rts, ys, names)
+        case "ms2":
+            rts, ys = run.ms2_search_batch(
+                masses,
+                kind=query.get("peaks", "prof"),
+                tolerance=query.get("tolerance", 20),
+                rt_range=query.get("rt_range"),
+            )
+            return _trace_frame(rts, ys, names)
+        case "prm":
+            return run.prm_extract(
+                query["assay"],
+                tolerance=query.get("tolerance", 20),
+                transition_tolerance=query.get("transition_tolerance", 25),
+                rt_range=query.get("rt_range"),
+            )
+        case "tic":
+            return run.chromatograms(
+                ms_level=query.get("ms_level", 1), rt_range=query.get("rt_range")
+            )
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+def _checkpoint_path(checkpoint_dir, path, queries):
+    """
+    Checkpoint file of one run, unique per absolute path, size and
+    modification time of the source file and per query list, so a result
+    is only reused for the same queries on the same, unchanged file.
+    """
+    source = os.stat(path)
+    digest = hashlib.sha1(os.path.abspath(path).encode())
+    digest.update(f"{source.st_size}:{source.st_mtime_ns}".encode())
+    digest.update(pickle.dumps(queries))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(checkpoint_dir, f"{stem}-{digest.hexdigest()[:12]}.pkl")
+
+
+def _limit_memory(max_memory):
+    """Process pool initializer capping the address space of a worker."""
+    if max_memory is not None and resource is not None:
+        limit = int(max_memory)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _process_run(path, queries, run_kwargs, checkpoint_dir):
+    """
+    Process pool target: open one run, apply every query and, when
+    requested, write the result to its checkpoint.
+
+    returns result (pd.DataFrame or None), timing (dict)
+    """
+    start = time.perf_counter()
+    timing = {"file": path, "status": "done", "error": "", "load_s": np.nan}
+    try:
+        run = open_run(path, **run_kwargs)
+        timing["load_s"] = time.perf_counter() - start
+        if run.ingest_stats is not None:
+            report = run.ingest_stats.report()
+            for name in run.ingest_stats.stages:
+                timing[f"ingest_{name}_s"] = report[f"{name}_s"]
+            timing["peak_memory_bytes"] = report["peak_memory_bytes"]
+
+        frames = []
+        for i, query in enumerate(queries):
+            frame = apply_query(run, query)
+            frame.insert(0, "query", query.get("name", f"{query['kind']}_{i}"))
+            frames.append(frame)
+        result = pd.concat(frames, ignore_index=True)
+        result.insert(0, "file", path)
+
+        if checkpoint_dir is not None:
+            checkpoint = _checkpoint_path(checkpoint_dir, path, queries)
+            result.to_pickle(checkpoint + ".tmp")
+            os.replace(checkpoint + ".tmp", checkpoint)
+    except Exception as excp:
+        result = None
+        timing["status"] = "failed"
+        timing["error"] = f"{type(excp).__name__}: {excp}"
+
+    timing["total_s"] = time.perf_counter() - start
+    timing["rows"] = 0 if result is None else result.shape[0]
+    return result, timing
+
+
+def _run_pool(paths, queries, run_kwargs, checkpoint_dir, workers, max_memory):
+    """
+    Process the runs of `paths` in one process pool.
+
+    returns (result, timing) of every finished run (list), runs lost to a
+    broken pool (list)
+    """
+    done, lost = [], []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        max_tasks_per_child=1,
+        initializer=_limit_memory,
+        initargs=(max_memory,),
+    ) as pool:
+        futures = {
+            pool.submit(_process_run, path, queries, run_kwargs, checkpoint_dir): path
+            for path in paths
+        }
+        for future in as_completed(futures):
+            try:
+                done.append(future.result())
+            except BrokenProcessPool:
+                lost.append(futures[future])
+    return done, lost
+
+
+def run_batch(runs, queries, workers=4, max_memory=None, checkpoint_dir=None,
+              run_kwargs=None):
+    """
+    Apply the same queries to many runs in a process pool.
+
+    Each worker handles one run at a time and is replaced after every run,
+    so memory of a finished run is always returned to the OS. Replacing
+    workers needs the spawn start method, so scripts calling run_batch
+    must guard it with `if __name__ == "__main__":`, and it cannot be run
+    from code read on stdin.
+
+    A worker killed from outside, e.g. by the OOM killer, breaks the whole
+    pool. The runs it took down are retried in a fresh pool, and runs lost
+    a second time are retried alone, so only the run that is killed on its
+    own is reported as failed.
+
+    :arg runs:              (str, list)     directory to search with find_runs,
+                                            or list of run paths
+    :arg queries:           (list)          query specs, see apply_query
+    :arg workers:           (int)           number of worker processes
+    :arg max_memory:        (int) <optional>    address space limit per worker
+                                                in bytes; a run that exceeds it
+                                                fails instead of the node.
+                                                Memory-mapped stores count
+                                                towards it with their full size
+    :arg checkpoint_dir:    (str) <optional>    directory holding one result per
+                                                finished run and query list;
+                                                runs found there are skipped,
+                                                so a crashed batch resumes where
+                                                it stopped. Edited source files
+                                                and changed queries are run again
+    :arg run_kwargs:        (dict) <optional>   passed to mzXML/mzML
+
+    returns merged long-form results (pd.DataFrame), per-file timings
+    (pd.DataFrame)
+    """
+    if isinstance(runs, str):
+        runs = find_runs(runs)
+    run_kwargs = dict(run_kwargs or {})
+
+    results, timings = [], []
+    pending = list(runs)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        pending = []
+        for path in runs:
+            checkpoint = _checkpoint_path(checkpoint_dir, path, queries)
+            if os.path.isfile(checkpoint):
+                results.append(pd.read_pickle(checkpoint))
+                timings.append({"file": path, "status": "resumed", "error": "",
+                                "load_s": np.nan, "total_s": 0.0,
+                                "rows": results[-1].shape[0]})
+            else:
+                pending.append(path)
+
+    args = (queries, run_kwargs, checkpoint_dir)
+    done, lost = _run_pool(pending, *args, workers, max_memory)
+    if lost:
+        retried, lost = _run_pool(lost, *args, workers, max_memory)
+        done.extend(retried)
+    for path in lost:
+        retried, killed = _run_pool([path], *args, 1, max_memory)
+        done.extend(retried)
+        if killed:
+            done.append((None, {"file": path, "status": "failed",
+                                "error": "BrokenProcessPool: worker killed",
+                                "load_s": np.nan, "total_s": np.nan, "rows": 0}))
+
+    for result, timing in done:
+        timings.append(timing)
+        if result is not None:
+            results.append(result)
+
+    merged = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    return merged, pd.DataFrame(timings)
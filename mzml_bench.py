@@ -0,0 +1,471 @@
+##########################################################
+# benchmarks for the my_mzml readers on synthetic data   #
+##########################################################
+
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from my_mzml import ScanStore, mzXML
+
+# precursors of the synthetic runs and the fragments of each of them
+SYNTHETIC_TARGETS = {
+    524.2648: (175.1190, 262.1510, 375.2350, 488.3191),
+    663.8512: (147.1128, 304.1867, 433.2293, 546.3134),
+    785.8426: (120.0808, 249.1234, 378.1660, 506.2246),
+}
+
+
+def synthetic_store(n_scans=2000, peaks_per_scan=500, ms2_per_ms1=0, seed=0):
+    """
+    Build an in-memory ScanStore of random centroided scans.
+
+    :arg n_scans:           (int)   number of scans in the run
+    :arg peaks_per_scan:    (int)   number of peaks in every scan
+    :arg ms2_per_ms1:       (int)   MS2 scans following each MS1 scan
+    :arg seed:              (int)   seed of the random generator
+
+    returns ScanStore
+    """
+    rng = np.random.default_rng(seed)
+
+    ms_level = np.ones(n_scans, dtype=np.int8)
+    cycle = ms2_per_ms1 + 1
+    ms_level[np.arange(n_scans) % cycle != 0] = 2
+    ms2 = np.flatnonzero(ms_level == 2)
+
+    mz = np.sort(rng.uniform(100, 2000, size=(n_scans, peaks_per_scan)), axis=1)
+    intensity = rng.exponential(1e5, size=(n_scans, peaks_per_scan)).astype(np.float32)
+    offsets = np.arange(n_scans + 1, dtype=np.int64) * peaks_per_scan
+
+    return ScanStore(
+        scan_num=np.arange(1, n_scans + 1, dtype=np.int64),
+        rt=np.linspace(0, 120, n_scans),
+        ms_level=ms_level,
+        offsets=offsets,
+        mz=mz.ravel(),
+        intensity=intensity.ravel(),
+        prec_scan=ms2.astype(np.int64),
+        prec_mz=rng.uniform(400, 1200, size=ms2.shape[0]),
+        prec_charge=rng.integers(2, 5, size=ms2.shape[0]).astype(np.int8),
+        prec_intensity=rng.exponential(1e6, size=ms2.shape[0]),
+    )
+
+
+def _encode_peaks(mz, intensity, precision, compression):
+    """Interleave, pack in network order and base64-encode one peak list."""
+    pairs = np.empty(mz.shape[0] * 2, dtype=f">f{precision // 8}")
+    pairs[0::2] = mz
+    pairs[1::2] = intensity
+    raw = pairs.tobytes()
+    if compression == "zlib":
+        raw = zlib.compress(raw)
+    return base64.b64encode(raw).decode("ascii"), len(raw)
+
+
+def _profile(centers, heights, points_per_peak, width):
+    """Expand centroids into gaussian profile peaks sampled around each center."""
+    steps = np.linspace(-2 * width, 2 * width, points_per_peak)
+    mz = (centers[:, None] + steps[None, :]).ravel()
+    intensity = (heights[:, None] * np.exp(-0.5 * (steps[None, :] / width) ** 2)).ravel()
+    order = np.argsort(mz, kind="stable")
+    return mz[order], intensity[order]
+
+
+def write_mzxml(path, n_scans=2000, peaks_per_scan=500, ms2_per_ms1=4, mode="centroid",
+                compression="zlib", precision=32, points_per_peak=7, run_time=120.0,
+                targets=None, seed=0):
+    """
+    Write an indexed mzXML file of random scans with known signals.
+
+    Every MS1 scan holds the precursors of `targets` eluting as gaussian
+    peaks over the run, and the MS2 scans cycle over those precursors with
+    their fragments on top of random background peaks.
+
+    :arg path:              (str)   file to write
+    :arg n_scans:           (int)   number of scans in the run
+    :arg peaks_per_scan:    (int)   number of (centroided) peaks in every scan
+    :arg ms2_per_ms1:       (int)   MS2 scans following each MS1 scan
+    :arg mode:              (str)   "centroid" or "profile"; profile scans hold
+                                    `points_per_peak` points for every peak
+    :arg compression:       (str)   "zlib" or "none"
+    :arg precision:         (int)   32 or 64 bit floats
+    :arg points_per_peak:   (int)   points of each profile peak
+    :arg run_time:          (float) length of the run in minutes
+    :arg targets:           (dict) <optional>   {precursor m/z: fragment m/z values},
+                                                SYNTHETIC_TARGETS by default
+    :arg seed:              (int)   seed of the random generator
+
+    returns path
+    """
+    if mode not in ("centroid", "profile"):
+        raise ValueError(f"Unknown mode {mode}")
+    if compression not in ("zlib", "none"):
+        raise ValueError(f"Unknown compression {compression}")
+    if precision not in (32, 64):
+        raise ValueError(f"Unknown precision {precision}")
+
+    rng = np.random.default_rng(seed)
+    targets = SYNTHETIC_TARGETS if targets is None else targets
+    precursors = np.array(list(targets.keys()), dtype=np.float64)
+    fragments = [np.asarray(f, dtype=np.float64) for f in targets.values()]
+    # elution apex of every target, spread over the middle of the run
+    apexes = np.linspace(0.25, 0.75, precursors.shape[0]) * run_time
+    elution_width = run_time / 60
+
+    rts = np.linspace(0, run_time, n_scans)
+    cycle = ms2_per_ms1 + 1
+    offsets = []
+    with open(path, "wb") as handle:
+        handle.write(
+            (
+                '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                '<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.2">\n'
+                f'<msRun scanCount="{n_scans}" startTime="PT0S" endTime="PT{run_time * 60}S">\n'
+            ).encode()
+        )
+        for i in range(n_scans):
+            num = i + 1
+            ms_level = 1 if i % cycle == 0 else 2
+            elution = np.exp(-0.5 * ((rts[i] - apexes) / elution_width) ** 2)
+
+            mz = rng.uniform(100, 2000, peaks_per_scan)
+            intensity = rng.exponential(1e4, peaks_per_scan)
+            precursor = ""
+            if ms_level == 1:
+                n_known = min(precursors.shape[0], peaks_per_scan)
+                mz[:n_known] = precursors[:n_known]
+                intensity[:n_known] = 1e3 + 1e7 * elution[:n_known]
+            else:
+                target = (i % cycle - 1) % precursors.shape[0]
+                n_known = min(fragments[target].shape[0], peaks_per_scan)
+                mz[:n_known] = fragments[target][:n_known]
+                intensity[:n_known] = 1e2 + 1e6 * elution[target]
+                precursor = (
+                    f'<precursorMz precursorIntensity="{1e7 * elution[target]:.1f}" '
+                    f'precursorCharge="2" windowWideness="1.6">'
+                    f"{precursors[target]:.4f}</precursorMz>\n"
+                )
+
+            order = np.argsort(mz, kind="stable")
+            mz, intensity = mz[order], intensity[order]
+            if mode == "profile":
+                mz, intensity = _profile(mz, intensity, points_per_peak, width=0.01)
+            peaks, length = _encode_peaks(mz, intensity, precision, compression)
+
+            offsets.append((num, handle.tell()))
+            handle.write(
+                (
+                    f'<scan num="{num}" msLevel="{ms_level}" peaksCount="{mz.shape[0]}" '
+                    f'centroided="{int(mode == "centroid")}" retentionTime="PT{rts[i] * 60:.4f}S">\n'
+                    f"{precursor}"
+                    f'<peaks precision="{precision}" byteOrder="network" contentType="m/z-int" '
+                    f'compressionType="{compression}" compressedLen="{length}">{peaks}</peaks>\n'
+                    "</scan>\n"
+                ).encode()
+            )
+        handle.write(b"</msRun>\n")
+        index_offset = handle.tell()
+        handle.write(b'<index name="scan">\n')
+        for num, offset in offsets:
+            handle.write(f'<offset id="{num}">{offset}</offset>\n'.encode())
+        handle.write(f"</index>\n<indexOffset>{index_offset}</indexOffset>\n</mzXML>\n".encode())
+    return path
+
+
+def _time(func, *args, repeat=3, **kwargs):
+    """Return best wall time (s) of `repeat` calls of func."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_xic_scaling(target_counts=(1, 10, 100, 1000, 5000), n_scans=2000,
+                      peaks_per_scan=500, tolerance=10, loop_limit=100, seed=0):
+    """
+    Compare mzXML.ms1_extract_batch against one ms1_extract call per target
+    for a growing number of targets.
+
+    The per-target loop is only timed up to `loop_limit` targets and
+    extrapolated linearly above that.
+
+    returns pd.DataFrame with one row per target count
+    """
+    run = mzXML.from_store(synthetic_store(n_scans, peaks_per_scan, seed=seed))
+    rng = np.random.default_rng(seed)
+
+    rows = []
+    for n_targets in target_counts:
+        targets = rng.uniform(100, 2000, size=n_targets)
+        batch = _time(run.ms1_extract_batch, targets, tolerance=tolerance)
+
+        looped = targets[:loop_limit]
+        loop = _time(
+            lambda: [run.ms1_extract(t, tolerance=tolerance) for t in looped], repeat=1
+        )
+        loop = loop * n_targets / looped.shape[0]
+
+        rows.append({
+            "targets": n_targets,
+            "scans": n_scans,
+            "batch_s": batch,
+            "loop_s": loop,
+            "speedup": loop / batch,
+        })
+    return pd.DataFrame(rows)
+
+
+def _traced(func, *args, **kwargs):
+    """
+    Call func once with tracemalloc running.
+
+    returns result, wall time (s), peak traced allocation (bytes)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_load(path, workers=1, repeat=3):
+    """
+    Time the ways of opening one run.
+
+    parse:  full XML parse and decode, no store written
+    build:  parse and write the columnar store next to the file
+    open:   memory-map the store written by build
+    headers: header-only pass, no peaks decoded
+
+    Peak memory is taken from a separate traced call of each stage, so
+    tracing does not inflate the timings. tracemalloc only sees this
+    process, so the *_parent_peak_bytes fields leave out the decoding
+    workers; their peak resident memory is reported separately as
+    *_workers_peak_rss_bytes (0 when the run was decoded serially).
+
+    returns dict of metrics
+    """
+    def build_store():
+        # every build starts without a store to open
+        shutil.rmtree(path + ".mzstore", ignore_errors=True)
+        return mzXML(path, use_store=True, workers=workers)
+
+    parse = _time(mzXML, path, use_store=False, workers=workers, repeat=repeat)
+    run, _, parse_peak = _traced(mzXML, path, use_store=False, workers=workers)
+    build = _time(build_store, repeat=repeat)
+    built, _, build_peak = _traced(build_store)
+    opened = _time(mzXML, path, use_store=True, repeat=repeat)
+    headers = _time(lambda: mzXML(path, lazy=True).headers(), repeat=repeat)
+    _, _, open_peak = _traced(mzXML, path, use_store=True)
+    shutil.rmtree(path + ".mzstore", ignore_errors=True)
+
+    return {
+        "file_bytes": os.path.getsize(path),
+        "scans": int(run.store.n_scans),
+        "peaks": int(run.store.mz.shape[0]),
+        "workers": workers,
+        # mzXML decodes with at most one worker per CPU
+        "decode_workers": min(workers, os.cpu_count() or 1),
+        "parse_s": parse,
+        "parse_parent_peak_bytes": parse_peak,
+        "parse_workers_peak_rss_bytes": run.ingest_stats.workers_peak_memory,
+        "parse_scans_per_s": run.store.n_scans / parse,
+        "build_s": build,
+        "build_parent_peak_bytes": build_peak,
+        "build_workers_peak_rss_bytes": built.ingest_stats.workers_peak_memory,
+        "open_s": opened,
+        "open_peak_bytes": open_peak,
+        "headers_s": headers,
+    }
+
+
+def bench_queries(run, n_queries=200, rt_width=2.0, tolerance=10, seed=0):
+    """
+    Throughput of the single-target extraction methods of one run, on the
+    whole run and on an RT window of `rt_width` minutes.
+
+    Half of the queries hit the known targets of the synthetic run, the
+    other half are random masses.
+
+    returns dict of metrics; throughputs are queries per second
+    """
+    rng = np.random.default_rng(seed)
+    precursors = np.array(list(SYNTHETIC_TARGETS.keys()))
+    fragments = np.concatenate([np.asarray(f) for f in SYNTHETIC_TARGETS.values()])
+    half = n_queries // 2
+    ms1_targets = np.concatenate([
+        rng.choice(precursors, n_queries - half), rng.uniform(100, 2000, half)
+    ])
+    ms2_targets = np.concatenate([
+        rng.choice(fragments, n_queries - half), rng.uniform(100, 2000, half)
+    ])
+    rt = np.asarray(run.store.rt)
+    starts = rng.uniform(rt.min(), max(rt.min(), rt.max() - rt_width), n_queries)
+    windows = np.stack([starts, starts + rt_width], axis=1)
+
+    def throughput(func, targets, windowed=False):
+        if windowed:
+            seconds = _time(
+                lambda: [func(t, rt_range=w) for t, w in zip(targets, windows)], repeat=1
+            )
+        else:
+            seconds = _time(lambda: [func(t) for t in targets], repeat=1)
+        return targets.shape[0] / seconds
+
+    _, index_build, index_peak = _traced(run.fragment_index, "prof")
+    _, rt_build, _ = _traced(run.rt_index, 1)
+
+    def prm(prec_mass, rt_range=None):
+        transitions = SYNTHETIC_TARGETS.get(prec_mass, fragments[:4])
+        try:
+            return run.prm_transition_extract(prec_mass, transitions, rt_range=rt_range)
+        except Exception:
+            # random precursors are not in the run
+            return None
+
+    prm_targets = np.concatenate([
+        rng.choice(precursors, n_queries - half), rng.uniform(400, 1200, half)
+    ])
+    return {
+        "queries": n_queries,
+        "rt_width": rt_width,
+        "rt_index_build_s": rt_build,
+        "fragment_index_build_s": index_build,
+        "fragment_index_peak_bytes": index_peak,
+        "ms1_extract_qps": throughput(
+            lambda t: run.ms1_extract(t, tolerance=tolerance), ms1_targets
+        ),
+        "ms1_extract_window_qps": throughput(
+            lambda t, rt_range: run.ms1_extract(t, tolerance=tolerance, rt_range=rt_range),
+            ms1_targets, windowed=True,
+        ),
+        "ms2_search_qps": throughput(run.ms2_search, ms2_targets),
+        "ms2_search_window_qps": throughput(run.ms2_search, ms2_targets, windowed=True),
+        "prm_transition_extract_qps": throughput(prm, prm_targets),
+        "prm_transition_extract_window_qps": throughput(prm, prm_targets, windowed=True),
+    }
+
+
+def bench_scaling(sizes=(500, 1000, 2000, 4000), peaks_per_scan=300, ms2_per_ms1=4,
+                  mode="centroid", compression="zlib", n_queries=100, workers=1,
+                  directory=None, seed=0):
+    """
+    Load and query metrics for synthetic runs of growing number of scans.
+
+    :arg sizes:     (tuple) scan counts of the runs
+    :arg directory: (str) <optional>    where the synthetic files are written,
+                                        a temporary directory by default
+
+    returns list of dicts, one per size
+    """
+    rows = []
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for n_scans in sizes:
+            path = os.path.join(tmp, f"synthetic_{n_scans}.mzXML")
+            write_mzxml(
+                path, n_scans=n_scans, peaks_per_scan=peaks_per_scan,
+                ms2_per_ms1=ms2_per_ms1, mode=mode, compression=compression, seed=seed,
+            )
+            row = {"n_scans": n_scans, "peaks_per_scan": peaks_per_scan,
+                   "ms2_per_ms1": ms2_per_ms1, "mode": mode, "compression": compression}
+            row.update(bench_load(path, workers=workers))
+            run = mzXML(path, use_store=False)
+            row.update(bench_queries(run, n_queries=n_queries, seed=seed))
+            rows.append(row)
+            os.remove(path)
+    return rows
+
+
+def run_suite(output=None, sizes=(500, 1000, 2000, 4000), peaks_per_scan=300,
+              ms2_per_ms1=4, modes=("centroid", "profile"), compressions=("zlib", "none"),
+              n_queries=100, workers=1, seed=0):
+    """
+    Run every benchmark and collect the results in one JSON-serializable dict.
+
+    Scaling curves are measured for every mode/compression pair; the batch
+    XIC comparison runs on an in-memory store.
+
+    :arg output:    (str) <optional>    JSON file the results are written to
+
+    returns dict with meta, scaling and xic_batch entries
+    """
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": seed,
+        },
+        "scaling": [],
+    }
+    for mode in modes:
+        for compression in compressions:
+            results["scaling"].extend(bench_scaling(
+                sizes=sizes, peaks_per_scan=peaks_per_scan, ms2_per_ms1=ms2_per_ms1,
+                mode=mode, compression=compression, n_queries=n_queries,
+                workers=workers, seed=seed,
+            ))
+    results["xic_batch"] = bench_xic_scaling(seed=seed).to_dict(orient="records")
+
+    if output is not None:
+        with open(output, "w") as handle:
+            json.dump(results, handle, indent=2, default=float)
+    return results
+
+
+def compare_results(baseline, current):
+    """
+    Compare two run_suite results (dicts or JSON paths) metric by metric.
+
+    returns pd.DataFrame with baseline, current and ratio (current / baseline)
+    of every numeric scaling metric
+    """
+    frames = []
+    for results in (baseline, current):
+        if isinstance(results, str):
+            with open(results) as handle:
+                results = json.load(handle)
+        frames.append(pd.DataFrame(results["scaling"]))
+
+    keys = ["mode", "compression", "n_scans"]
+    merged = frames[0].merge(frames[1], on=keys, suffixes=("_baseline", "_current"))
+    rows = []
+    for column in frames[0].columns:
+        if column in keys or not pd.api.types.is_numeric_dtype(frames[0][column]):
+            continue
+        if f"{column}_current" not in merged:
+            continue
+        part = merged.loc[:, keys].copy()
+        part["metric"] = column
+        part["baseline"] = merged[f"{column}_baseline"]
+        part["current"] = merged[f"{column}_current"]
+        part["ratio"] = part["current"] / part["baseline"]
+        rows.append(part)
+    return pd.concat(rows, ignore_index=True)
+
+
+if __name__ == "__main__":
+    output = sys.argv[1] if len(sys.argv) > 1 else "mzml_bench.json"
+    results = run_suite(output=output)
+    print(pd.DataFrame(results["scaling"]).to_string(index=False))
+    print(pd.DataFrame(results["xic_batch"]).to_string(index=False))
+    print(f"Results written to {output}")
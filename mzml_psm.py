@@ -0,0 +1,326 @@
+####################################################################
+# module to annotate search engine PSMs against the scans of a run #
+####################################################################
+
+import os
+import re
+import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from my_mzml import ScanStore, _ragged_index, _range_index
+from mzml_batch import open_run
+from ms_fragments import _residue_table, fragment_ladders
+
+PSM_COLUMNS = ("sequence", "charge", "scan")
+
+METRIC_COLUMNS = (
+    "n_ions", "n_matched", "matched_fraction", "matched_intensity",
+    "explained_intensity", "ppm_mean", "ppm_median", "ppm_std", "ppm_abs_max",
+)
+
+
+def psm_table(source, aa_mass=None):
+    """
+    Normalize the PSMs of a search engine result into sequence, charge and
+    scan columns, keeping the original index.
+
+    :arg source:    MSFProcessor (spectrum or scan_number column),
+                    PDProcessor (psms with first_scan), ByFile (scan_#) or
+                    pd.DataFrame that already holds sequence, charge and scan
+
+    :arg aa_mass:   (dict) <optional>   residue masses of modified residues;
+                                        without it sequences are upper-cased
+
+    returns pd.DataFrame with PSM_COLUMNS; sequences are stripped of
+    flanking residues and bracketed mass tags
+    """
+    if hasattr(source, "psms"):
+        # PDProcessor
+        frame = source.psms
+        table = pd.DataFrame({
+            "sequence": frame["sequence"],
+            "charge": frame["charge"],
+            "scan": frame["first_scan"],
+        })
+    elif hasattr(source, "frame"):
+        # ByFile
+        frame = source.frame
+        table = pd.DataFrame({
+            "sequence": frame["clean_peptide"],
+            "charge": frame["z"],
+            "scan": frame["scan_#"].map(_scan_number),
+        })
+    elif hasattr(source, "data_files"):
+        # MSFProcessor
+        frame = source.data
+        if "scan_number" in frame:
+            scans = frame["scan_number"]
+        else:
+            scans = frame["spectrum"].map(_scan_number)
+        table = pd.DataFrame({
+            "sequence": frame["peptide"],
+            "charge": frame["charge"],
+            "scan": scans,
+        })
+    else:
+        missing = [c for c in PSM_COLUMNS if c not in source]
+        if missing:
+            raise ValueError(f"PSM table is missing columns {missing}")
+        table = source.loc[:, list(PSM_COLUMNS)].copy()
+
+    # sequences repeat across PSMs, clean each distinct one once
+    codes, uniques = pd.factorize(table.sequence)
+    cleaned = [_plain_sequence(str(u)) for u in uniques]
+    if aa_mass is None:
+        cleaned = [c.upper() for c in cleaned]
+    table["sequence"] = np.array(cleaned + [""], dtype=object)[codes]
+    table["charge"] = pd.to_numeric(table.charge, errors="coerce").fillna(0).astype(np.int8)
+    table["scan"] = pd.to_numeric(table.scan, errors="coerce").fillna(-1).astype(np.int64)
+    return table
+
+
+def _scan_number(spectrum):
+    """
+    Scan number of a spectrum reference: plain numbers, native IDs with
+    scan=N, or MSFragger/TPP names file.N.N.z.
+    """
+    spectrum = str(spectrum)
+    if spectrum.isdigit():
+        return int(spectrum)
+    match = re.search(r"scan=(\d+)", spectrum) or re.search(r"\.(\d+)\.\d+\.\d+$", spectrum)
+    return int(match.group(1)) if match else -1
+
+
+def _plain_sequence(sequence):
+    """Sequence without flanking residues (K.PEPTIDE.R) or bracketed mass tags."""
+    match = re.fullmatch(r"(?:\[?[A-Z-]\]?\.)?(.*?)(?:\.\[?[A-Z-]\]?)?", sequence)
+    if match:
+        sequence = match.group(1)
+    return re.sub(r"\[[^\]]*\]", "", sequence)
+
+
+def _known_residues(peptides, aa_mass=None):
+    """Mask of the non-empty peptides whose residues all have a mass."""
+    lengths = np.fromiter((len(p) for p in peptides), dtype=np.int64, count=len(peptides))
+    codes = np.frombuffer("".join(peptides).encode("ascii", "replace"), dtype=np.uint8)
+    unknown = np.isnan(_residue_table(aa_mass)[codes])
+    n_unknown = np.bincount(
+        np.repeat(np.arange(lengths.shape[0]), lengths), weights=unknown,
+        minlength=lengths.shape[0],
+    )
+    return (lengths > 0) & (n_unknown == 0)
+
+
+def _store_directory(store):
+    """
+    Directory the columns of `store` are memory-mapped from, when it still
+    holds that store (same meta), else None.
+    """
+    if not isinstance(store.mz, np.memmap) or store.mz.filename is None:
+        return None
+    path = os.path.dirname(store.mz.filename)
+    try:
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return path if meta == store.meta else None
+
+
+def _annotate_chunk(store, sequences, charges, positions, types, max_charge, tolerance,
+                    aa_mass=None):
+    """
+    Process pool target of annotate_psms: metrics of one chunk of PSMs.
+
+    :arg store:     (ScanStore, str)    store, or directory of a saved store
+                                        that is memory-mapped
+    :arg positions: (np.array)  store position of the scan of every PSM,
+                                -1 when the scan is not in the run
+
+    PSMs with residues that have no mass in `aa_mass` are left unannotated.
+
+    returns dict of np.arrays, see METRIC_COLUMNS
+    """
+    if isinstance(store, str):
+        store = ScanStore.load(store)
+    n_psms = len(sequences)
+    metrics = {name: np.full(n_psms, np.nan) for name in METRIC_COLUMNS}
+    sequences = np.asarray(sequences, dtype=object)
+    found = np.flatnonzero(positions >= 0)
+
+    # one ladder per unique peptide of the chunk
+    peptides, pep_of_psm = np.unique(sequences[found], return_inverse=True)
+    valid = _known_residues(peptides, aa_mass)
+    if not valid.all():
+        found, pep_of_psm = found[valid[pep_of_psm]], pep_of_psm[valid[pep_of_psm]]
+        peptides = peptides[valid]
+        # renumber the remaining peptides
+        pep_of_psm = np.cumsum(valid)[pep_of_psm] - 1
+    if found.shape[0] == 0:
+        return metrics
+    ladders = fragment_ladders(list(peptides), types=types, max_charge=max_charge, aa_mass=aa_mass)
+    ion_offsets = ladders["offsets"]
+
+    # theoretical ions of every PSM, fragments above the precursor charge dropped
+    ion_index, ion_psm = _range_index(ion_offsets[pep_of_psm], ion_offsets[pep_of_psm + 1])
+    keep = ladders["charge"][ion_index] <= np.maximum(charges[found][ion_psm], 1)
+    ion_index, ion_psm = ion_index[keep], ion_psm[keep]
+    theoretical = ladders["mz"][ion_index]
+    n_ions = np.bincount(ion_psm, minlength=found.shape[0])
+
+    # peaks of the chunk's scans, gathered once from the (memory-mapped) store
+    scans, scan_of_psm = np.unique(positions[found], return_inverse=True)
+    offsets = np.asarray(store.offsets)
+    peak_index, peak_scan = _ragged_index(offsets, scans)
+    mz = np.asarray(store.mz[peak_index], dtype=np.float64)
+    intensity = np.asarray(store.intensity[peak_index], dtype=np.float64)
+    lengths = offsets[scans + 1] - offsets[scans]
+    scan_starts = np.cumsum(lengths) - lengths
+
+    # nearest observed peak of every ion inside the spectrum of its PSM.
+    # Peaks are sorted by m/z within each scan, so scan + m/z / span is sorted
+    # over the whole chunk and one np.searchsorted replaces a search per scan
+    span = (mz.max() if mz.shape[0] else 0.0) + 1.0
+    keys = peak_scan + mz / span
+    ion_scan = scan_of_psm[ion_psm]
+    starts = scan_starts[ion_scan]
+    stops = starts + lengths[ion_scan]
+    right = np.searchsorted(keys, ion_scan + np.minimum(theoretical, span - 0.5) / span)
+    right = np.clip(right, starts, stops)
+    filled = stops > starts
+    left = np.maximum(right - 1, starts)
+    right = np.minimum(right, np.maximum(stops - 1, starts))
+    mz_left = mz[np.where(filled, left, 0)] if mz.shape[0] else np.zeros(right.shape[0])
+    mz_right = mz[np.where(filled, right, 0)] if mz.shape[0] else np.zeros(right.shape[0])
+    use_right = np.abs(mz_right - theoretical) < np.abs(mz_left - theoretical)
+    peak = np.where(use_right, right, left)
+    observed = np.where(use_right, mz_right, mz_left)
+    ppm = (theoretical - observed) / theoretical * 1e6
+    hit = filled & (np.abs(ppm) <= tolerance)
+    hit_psm, hit_peak, hit_ppm = ion_psm[hit], peak[hit], ppm[hit]
+
+    n_matched = np.bincount(hit_psm, minlength=found.shape[0])
+    # every observed peak counts once towards the explained intensity
+    pairs = np.unique(hit_psm * mz.shape[0] + hit_peak)
+    matched_intensity = np.bincount(
+        pairs // mz.shape[0], weights=intensity[pairs % mz.shape[0]],
+        minlength=found.shape[0],
+    ) if pairs.shape[0] else np.zeros(found.shape[0])
+    total_intensity = np.asarray(store.tic[scans], dtype=np.float64)[scan_of_psm]
+
+    # ppm statistics per PSM from the errors sorted within each PSM
+    order = np.lexsort((hit_ppm, hit_psm))
+    sorted_ppm = hit_ppm[order]
+    group_start = np.cumsum(n_matched) - n_matched
+    has_hits = n_matched > 0
+    lower = group_start + (n_matched - 1) // 2
+    upper = group_start + n_matched // 2
+    sums = np.bincount(hit_psm, weights=hit_ppm, minlength=found.shape[0])
+    squares = np.bincount(hit_psm, weights=hit_ppm ** 2, minlength=found.shape[0])
+    abs_max = np.zeros(found.shape[0])
+    np.maximum.at(abs_max, hit_psm, np.abs(hit_ppm))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / n_matched
+        metrics["n_ions"][found] = n_ions
+        metrics["n_matched"][found] = n_matched
+        metrics["matched_fraction"][found] = n_matched / n_ions
+        metrics["matched_intensity"][found] = matched_intensity
+        metrics["explained_intensity"][found] = matched_intensity / total_intensity
+        metrics["ppm_mean"][found] = np.where(has_hits, mean, np.nan)
+        metrics["ppm_median"][found[has_hits]] = (
+            sorted_ppm[lower[has_hits]] + sorted_ppm[upper[has_hits]]
+        ) / 2
+        metrics["ppm_std"][found] = np.where(
+            has_hits, np.sqrt(np.maximum(squares / n_matched - mean ** 2, 0)), np.nan
+        )
+        metrics["ppm_abs_max"][found] = np.where(has_hits, abs_max, np.nan)
+    return metrics
+
+
+def annotate_psms(psms, run, types=("b", "y"), max_charge=2, tolerance=20, workers=4,
+                  chunk_size=50000, aa_mass=None):
+    """
+    Annotate the MS2 spectrum of every PSM of a search result with its
+    theoretical fragments and summarize the matches per PSM.
+
+    PSMs are joined to the scans of the run by scan number and split in
+    chunks of `chunk_size` that are annotated in a process pool. Workers
+    memory-map the directory the run's store is mapped from (next to the
+    source or in a StoreCache) instead of receiving its peaks; a store that
+    is not mapped from disk is written to a temporary directory first. Inside
+    a chunk, ladders are built once per peptide and all ions are matched to
+    their nearest peak with one np.searchsorted.
+
+    :arg psms:          PSM source, see psm_table
+    :arg run:           (mzXML, str)    run the PSMs were searched from
+    :arg types:         (tuple) ion types, see ms_fragments.fragment_ladders
+    :arg max_charge:    (int)   maximum fragment charge; fragments above
+                                the precursor charge are skipped
+    :arg tolerance:     (float) ppm tolerance of fragment matching
+    :arg workers:       (int)   number of processes, 1 runs in-process
+    :arg chunk_size:    (int)   PSMs per task
+    :arg aa_mass:       (dict) <optional>   residue masses, e.g. lower case
+                                            modified residues of PDProcessor
+
+    returns pd.DataFrame with the PSM_COLUMNS and METRIC_COLUMNS, indexed
+    like the PSM table; metrics are nan for PSMs whose scan is not in the
+    run or whose sequence has unknown residues. explained_intensity is the
+    matched fraction of the scan's TIC
+    """
+    if isinstance(run, str):
+        run = open_run(run)
+    table = psm_table(psms, aa_mass=aa_mass)
+    store = run.store
+
+    scans = table.scan.to_numpy()
+    positions = np.searchsorted(store.scan_num, scans)
+    positions = np.minimum(positions, store.n_scans - 1)
+    positions = np.where(np.asarray(store.scan_num[positions]) == scans, positions, -1)
+
+    sequences = table.sequence.to_numpy(dtype=object)
+    charges = table.charge.to_numpy()
+    bounds = list(range(0, table.shape[0], chunk_size)) + [table.shape[0]]
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+
+    temporary = None
+    if workers > 1 and len(chunks) > 1:
+        source = _store_directory(store)
+        if source is None:
+            temporary = tempfile.mkdtemp(suffix=".mzstore")
+            store.save(temporary)
+            source = temporary
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parts = list(pool.map(
+                    _annotate_chunk,
+                    [source] * len(chunks),
+                    [sequences[lo:hi] for lo, hi in chunks],
+                    [charges[lo:hi] for lo, hi in chunks],
+                    [positions[lo:hi] for lo, hi in chunks],
+                    [types] * len(chunks),
+                    [max_charge] * len(chunks),
+                    [tolerance] * len(chunks),
+                    [aa_mass] * len(chunks),
+                ))
+        finally:
+            if temporary is not None:
+                shutil.rmtree(temporary, ignore_errors=True)
+    else:
+        parts = [
+            _annotate_chunk(
+                store, sequences[lo:hi], charges[lo:hi], positions[lo:hi],
+                types, max_charge, tolerance, aa_mass,
+            )
+            for lo, hi in chunks
+        ]
+
+    for name in METRIC_COLUMNS:
+        table[name] = np.concatenate([p[name] for p in parts]) if parts else np.zeros(0)
+    for name in ("n_ions", "n_matched"):
+        table[name] = table[name].astype("Int64")
+    return table